@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+import shutil
+import typing
+import argparse
+import tempfile
+import itertools
+import collections
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from data_loader import DataLoader, SHARD_INDEX_FILE_NAME
+from model_logging import get_logger
+from training_loop_launcher import load_file, select_model
+
+logger = get_logger()
+
+DEFAULT_STATIONS = ["BND", "TBL", "DRA", "FPK", "GWN", "PSU", "SXF"]
+DEFAULT_TARGET_TIME_OFFSETS = ["P0DT0H0M0S", "P0DT1H0M0S", "P0DT3H0M0S", "P0DT6H0M0S"]
+
+
+def create_synthetic_batch_files(dir_path, nb_files, user_config, stations, nb_offsets):
+    """
+    Writes random batch files in the layout of the user config, for benchmarks without real data
+    """
+    # imported here since the batch creation dependencies are not needed to benchmark real data
+    import create_batch_files
+
+    storage_config = create_batch_files.get_batch_storage_config(user_config, {"stations": dict.fromkeys(stations)})
+    batch_size = user_config.get("mini_batch_size", 256)
+    image_shape = (user_config["input_seq_length"], user_config["image_size_m"], user_config["image_size_n"],
+                   user_config["nb_channels"])
+    random_state = np.random.RandomState(0)
+    for file_idx in range(nb_files):
+        images = random_state.randn(batch_size, *image_shape).astype(np.float32)
+        clearsky_ghis = random_state.uniform(0, 1000, (batch_size, nb_offsets)).astype(np.float32)
+        true_ghis = clearsky_ghis * random_state.uniform(0, 1, (batch_size, nb_offsets)).astype(np.float32)
+        night_flags = (random_state.uniform(0, 1, (batch_size, nb_offsets)) < 0.3).astype(np.float32)
+        station_ids = [stations[i] for i in random_state.randint(len(stations), size=batch_size)]
+        timestamps = pd.to_datetime(random_state.randint(1262304000, 1451606400, size=batch_size), unit='s')
+
+        if storage_config["layout"] == "sharded":
+            shard_path = os.path.join(dir_path, create_batch_files.SHARD_FILE_PREFIX + "0000000.hdf5")
+            create_batch_files.ShardWriter(shard_path, storage_config).append(
+                images, true_ghis, clearsky_ghis, station_ids, timestamps, night_flags)
+        else:
+            create_batch_files.save_image_and_batch(dir_path, "batch_" + str(file_idx).zfill(4), images, true_ghis,
+                                                    clearsky_ghis, station_ids, timestamps, night_flags,
+                                                    storage_config)
+    if storage_config["layout"] == "sharded":
+        create_batch_files.build_shard_index(dir_path)
+
+
+def get_latency_stats(step_times):
+    step_times = np.array(step_times) * 1000
+    return "p50 {:.1f} ms, p99 {:.1f} ms".format(np.percentile(step_times, 50), np.percentile(step_times, 99))
+
+
+def get_dataset_bytes(data_loader):
+    """Size on disk of the batch files of a data loader"""
+    paths = list(data_loader.data_files_list)
+    if data_loader.shard_index is not None:
+        paths.append(os.path.join(data_loader.data_folder, SHARD_INDEX_FILE_NAME))
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def repeat_batches(data_loader):
+    """Batches of the data loader, over as many epochs as needed (the data loader must not be empty)"""
+    while True:
+        yield from data_loader.data_generator_fn()
+
+
+def benchmark_generator(data_loader, nb_steps):
+    """
+    Times the batches of the Python generator alone, with the time spent in every read stage. The conversion
+    of the arrays to tensors, done by tf.data in training, is timed as its own stage
+    """
+    data_loader.stage_times = collections.defaultdict(float)
+    step_times = []
+    batches = repeat_batches(data_loader)
+    for _ in range(nb_steps):
+        start = time.perf_counter()
+        batch = next(batches)
+        with data_loader.time_stage("tensor_conversion"):
+            tuple(tf.convert_to_tensor(array) for array in batch)
+        step_times.append(time.perf_counter() - start)
+    batches.close()
+    stage_times, data_loader.stage_times = data_loader.stage_times, None
+    return step_times, stage_times
+
+
+def benchmark_pipeline(data_loader, nb_steps):
+    """
+    Times the batches of the full tf.data pipeline returned by get_data_loader, as consumed by the training loop
+
+    Returns:
+        The time taken by every step, and the number of samples and of decoded bytes of all the steps.
+    """
+    step_times, nb_samples, nb_bytes = [], 0, 0
+    start = time.perf_counter()
+    for minibatch in data_loader.get_data_loader().repeat().take(nb_steps):
+        end = time.perf_counter()
+        step_times.append(end - start)
+        nb_samples += int(minibatch[0].shape[0])
+        nb_bytes += sum(int(tf.size(t)) * t.dtype.size for t in minibatch)
+        start = end
+    return step_times, nb_samples, nb_bytes
+
+
+def benchmark_model_step(MainModel, stations, target_time_offsets, user_config, data_loader, nb_steps,
+                         nb_cached_batches):
+    """
+    Times the training step of the model on a few batches kept in memory as tensors, i.e. with a data loader
+    that costs nothing. The step is compiled as in training (see training_loop.compile_step)
+    """
+    # imported here since the training loop is only needed by this mode
+    from training_loop import get_optimizer, get_step_functions, precision_policy_scope
+
+    cached_batches = list(data_loader.get_data_loader().take(nb_cached_batches))
+    with precision_policy_scope(user_config):
+        model = MainModel(stations, target_time_offsets, user_config)
+    optimizer = get_optimizer(user_config["learning_rate"], user_config)
+    loss_fn = tf.keras.losses.MeanSquaredError(reduction="sum")
+    train_step, _ = get_step_functions(model, optimizer, loss_fn, user_config["max_k_ghi"],
+                                       data_loader.get_input_signature(), user_config)
+
+    step_times = []
+    # the first step builds (and traces) the model and is not timed
+    for minibatch in itertools.islice(itertools.cycle(cached_batches), nb_steps + 1):
+        start = time.perf_counter()
+        loss, _, _, _ = train_step(x_train=minibatch[:-1], y_train=minibatch[-1], use_image_data_only=False)
+        float(loss)  # waits for the step to complete
+        step_times.append(time.perf_counter() - start)
+    return step_times[1:], sum(int(b[0].shape[0]) for b in cached_batches) / len(cached_batches)
+
+
+def main(
+        user_config_path: typing.AnyStr,
+        train_config_path: typing.Optional[typing.AnyStr] = None,
+        data_folder: typing.Optional[typing.AnyStr] = None,
+        nb_steps: int = 100,
+        nb_synthetic_files: int = 0,
+        model_step: bool = False,
+        nb_cached_batches: int = 8,
+) -> None:
+    user_config = load_file(user_config_path, "user")
+    if train_config_path:
+        train_config = load_file(train_config_path, "training")
+        station_names = list(train_config["stations"].keys())
+        target_time_offsets = train_config["target_time_offsets"]
+    else:
+        station_names = user_config.get("onehot_stations", DEFAULT_STATIONS)
+        target_time_offsets = DEFAULT_TARGET_TIME_OFFSETS
+    # the coordinates of the stations are not used by the data loader
+    stations = {name: (0.0, 0.0, 0.0) for name in station_names}
+    target_time_offsets = [pd.Timedelta(d).to_pytimedelta() for d in target_time_offsets]
+
+    synthetic_folder = None
+    if nb_synthetic_files:
+        synthetic_folder = data_folder = tempfile.mkdtemp(prefix="synthetic_batches_")
+        create_synthetic_batch_files(data_folder, nb_synthetic_files, user_config, station_names,
+                                     len(target_time_offsets))
+    elif data_folder is None:
+        data_folder = os.path.expandvars(user_config["train_data_folder"])
+
+    MainModel = select_model(user_config) if "target_model" in user_config else None
+    required_inputs = MainModel.REQUIRED_INPUTS + ("night_flags",) if MainModel is not None else None
+    data_loader = DataLoader(pd.DataFrame(), [], stations, target_time_offsets, user_config, data_folder,
+                             required_inputs=required_inputs)
+    try:
+        assert data_loader.data_files_list, "no batch files in {}".format(data_folder)
+        print("Benchmarking {} steps on {} ({} files)".format(nb_steps, data_folder, len(data_loader.data_files_list)))
+
+        step_times, stage_times = benchmark_generator(data_loader, nb_steps)
+        print("Generator only: {}".format(get_latency_stats(step_times)))
+        if data_loader.num_parallel_reads > 1:
+            print("  read stages are timed in the reader processes and are not reported")
+        for stage, stage_time in stage_times.items():
+            print("  {:<18} {:8.3f} s ({:5.1f}%)".format(stage, stage_time, 100 * stage_time / sum(step_times)))
+
+        step_times, nb_samples, nb_bytes = benchmark_pipeline(data_loader, nb_steps)
+        total_time = sum(step_times)
+        disk_bytes = get_dataset_bytes(data_loader) * nb_samples / data_loader.count_samples()
+        print("tf.data pipeline: {}".format(get_latency_stats(step_times)))
+        print("  {:.1f} samples/s, {:.1f} MB/s decoded, {:.1f} MB/s on disk".format(
+            nb_samples / total_time, nb_bytes / total_time / 2 ** 20, disk_bytes / total_time / 2 ** 20))
+
+        if model_step:
+            assert MainModel is not None and MainModel.TRAINING_REQUIRED, "model step mode requires a trained model"
+            model_step_times, batch_size = benchmark_model_step(MainModel, stations, target_time_offsets,
+                                                                user_config, data_loader, nb_steps,
+                                                                nb_cached_batches)
+            print("Model step on cached tensors: {}".format(get_latency_stats(model_step_times)))
+            print("  {:.1f} samples/s".format(batch_size * len(model_step_times) / sum(model_step_times)))
+            input_bound = np.median(step_times) > np.median(model_step_times)
+            print("  training is {}input-bound".format("" if input_bound else "not "))
+    finally:
+        data_loader.close()
+        if synthetic_folder is not None:
+            shutil.rmtree(synthetic_folder, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--user_cfg_path", type=str,
+                        help="path to the JSON config file used to store user model/dataloader parameters",
+                        default="eval_user_cfg_cnn.json")
+    parser.add_argument("-t", "--train_cfg_path", type=str, default=None,
+                        help="path to the JSON config file of the training set, for its stations and time offsets")
+    parser.add_argument("-d", "--data_folder", type=str, default=None,
+                        help="folder of the batch files (default: train_data_folder of the user config)")
+    parser.add_argument("-n", "--steps", type=int, default=100,
+                        help="number of steps (batches) to time")
+    parser.add_argument("-s", "--synthetic_files", type=int, default=0,
+                        help="number of random batch files to generate and benchmark instead of real data")
+    parser.add_argument("-m", "--model_step", action="store_true",
+                        help="also time the training step of the model on batches cached as tensors")
+    parser.add_argument("--cached_batches", type=int, default=8,
+                        help="number of batches cached as tensors for the model step")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logger.info(str(sys.argv))
+    args = parse_args()
+    main(
+        user_config_path=args.user_cfg_path,
+        train_config_path=args.train_cfg_path,
+        data_folder=args.data_folder,
+        nb_steps=args.steps,
+        nb_synthetic_files=args.synthetic_files,
+        model_step=args.model_step,
+        nb_cached_batches=args.cached_batches,
+    )
@@ -6,6 +6,10 @@ import tensorflow as tf
 
 class MainModel(tf.keras.Model):
     TRAINING_REQUIRED = False
+    # inputs read by the DataLoader (see data_loader.INPUT_NAMES); the images are never needed
+    REQUIRED_INPUTS = ("clearsky_GHI",)
+    # inputs unused when training on image data only
+    IMAGE_ONLY_UNUSED_INPUTS = ()
 
     def __init__(
             self,
@@ -0,0 +1,213 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import typing
+import numpy as np
+import pandas as pd
+import tqdm
+
+# channels of the 8-bit HDF5 archive used by the models, in the order of the image channels
+CHANNEL_NAMES = ["ch1", "ch2", "ch3", "ch4", "ch6"]
+
+
+class RunningStats():
+    """
+    Streaming per-component count, mean, variance, min and max of a set of vectors. Batches are summarized then
+    merged with the parallel (Chan et al.) form of Welford's algorithm, which is also used to merge the statistics
+    computed by different workers
+    """
+
+    def __init__(self, shape=()):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, values):
+        """
+        :param values: (n, *shape) array of new vectors
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return self
+        batch = RunningStats(self.mean.shape)
+        batch.count = len(values)
+        batch.mean = values.mean(axis=0)
+        batch.m2 = ((values - batch.mean) ** 2).sum(axis=0)
+        batch.min = values.min(axis=0)
+        batch.max = values.max(axis=0)
+        return self.merge(batch)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def to_dict(self):
+        return {
+            "count": int(self.count),
+            "mean": self.mean.tolist(),
+            "std": np.sqrt(self.m2 / max(self.count, 1)).tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+        }
+
+
+def compute_file_statistics(args):
+    """
+    Worker task: statistics of the channels of the given frames of one HDF5 archive
+    :param args: (hdf5_path, hdf5_offsets, pixel_stride) tuple
+    :return: path of the archive, number of frames used and RunningStats of the (ch1, ch2, ch3, ch4, ch6) pixels
+    """
+    # imported here so that loading the statistics does not require the imagery dependencies
+    import utils
+
+    hdf5_path, hdf5_offsets, pixel_stride = args
+    stats = RunningStats((len(CHANNEL_NAMES),))
+    nb_frames = 0
+    with utils.open_hdf5(hdf5_path, use_reader_pool=False) as h5_data:
+        for hdf5_offset in hdf5_offsets:
+            channels = [utils.fetch_hdf5_sample(name, h5_data, hdf5_offset) for name in CHANNEL_NAMES]
+            if any(channel is None for channel in channels):
+                # unavailable frame
+                continue
+            pixels = np.stack([channel[::pixel_stride, ::pixel_stride] for channel in channels], axis=-1)
+            pixels = pixels.reshape(-1, len(CHANNEL_NAMES))
+            stats.update(pixels[np.isfinite(pixels).all(axis=1)])
+            nb_frames += 1
+    return hdf5_path, nb_frames, stats
+
+
+def compute_feature_statistics(dataframe, stations):
+    """
+    :return: dictionnary of feature name -> RunningStats of the daytime GHIs of all the stations
+    """
+    features = {"GHI": "_GHI", "clearsky_GHI": "_CLEARSKY_GHI"}
+    feature_stats = {}
+    for feature, column_suffix in features.items():
+        stats = RunningStats()
+        for station in stations:
+            daytime = dataframe[station + "_DAYTIME"] == 1
+            values = dataframe.loc[daytime, station + column_suffix].to_numpy(dtype=np.float64)
+            stats.update(values[np.isfinite(values)])
+        feature_stats[feature] = stats
+    return feature_stats
+
+
+def compute_statistics(
+        admin_config_path: typing.AnyStr,
+        output_path: typing.AnyStr,
+        frame_fraction: float = 1.0,
+        pixel_stride: int = 1,
+        workers: int = 4,
+        random_seed: int = 0,
+) -> None:
+    """
+    Single pass over the imagery archive of the admin config period, computing the per-channel statistics used to
+    standardize the images and the per-feature statistics used by the models, saved in a JSON file
+    frame_fraction: fraction of the frames to use (sampled at random), for a faster approximate pass
+    pixel_stride: only use every pixel_stride-th row and column of the frames, for a faster approximate pass
+    """
+    assert os.path.isfile(admin_config_path), f"invalid admin config file: {admin_config_path}"
+    with open(admin_config_path, "r") as fd:
+        admin_config = json.load(fd)
+
+    dataframe_path = admin_config["dataframe_path"]
+    assert os.path.isfile(dataframe_path), f"invalid dataframe path: {dataframe_path}"
+    dataframe = pd.read_pickle(dataframe_path)
+    dataframe = dataframe.replace('nan', np.nan)
+    if "start_bound" in admin_config:
+        dataframe = dataframe[dataframe.index >= datetime.datetime.fromisoformat(admin_config["start_bound"])]
+    if "end_bound" in admin_config:
+        dataframe = dataframe[dataframe.index < datetime.datetime.fromisoformat(admin_config["end_bound"])]
+
+    frames = dataframe.loc[dataframe["hdf5_8bit_path"].notnull(), ["hdf5_8bit_path", "hdf5_8bit_offset"]]
+    frames = frames.drop_duplicates()
+    if frame_fraction < 1.0:
+        frames = frames.sample(frac=frame_fraction, random_state=random_seed)
+    # one task per archive, so that each archive is opened by a single worker
+    tasks = [(hdf5_path, np.sort(group["hdf5_8bit_offset"].to_numpy().astype(int)), pixel_stride)
+             for hdf5_path, group in frames.groupby("hdf5_8bit_path")]
+
+    channel_stats = RunningStats((len(CHANNEL_NAMES),))
+    nb_frames = 0
+    with multiprocessing.Pool(workers) as pool:
+        for hdf5_path, file_frames, file_stats in tqdm.tqdm(pool.imap_unordered(compute_file_statistics, tasks),
+                                                            total=len(tasks)):
+            channel_stats.merge(file_stats)
+            nb_frames += file_frames
+
+    statistics = {
+        "channels": dict(names=CHANNEL_NAMES, **channel_stats.to_dict()),
+        "features": {name: stats.to_dict() for name, stats in
+                     compute_feature_statistics(dataframe, admin_config["stations"]).items()},
+        "sampling": {
+            "start_bound": admin_config.get("start_bound"),
+            "end_bound": admin_config.get("end_bound"),
+            "frame_fraction": frame_fraction,
+            "pixel_stride": pixel_stride,
+            "nb_frames": nb_frames,
+        },
+    }
+    with open(output_path, "w") as fd:
+        json.dump(statistics, fd, indent=2)
+    print("Statistics of {} frames saved to {}".format(nb_frames, output_path))
+
+
+def load_statistics(user_config):
+    """
+    :return: statistics saved by compute_statistics at the "statistics_path" of the user config, None if unset
+    """
+    statistics_path = user_config.get("statistics_path")
+    if statistics_path is None:
+        return None
+    statistics_path = os.path.expandvars(statistics_path)
+    assert os.path.isfile(statistics_path), f"invalid statistics file: {statistics_path}"
+    with open(statistics_path, "r") as fd:
+        return json.load(fd)
+
+
+def get_feature_normalization(user_config, feature, default_mean, default_std):
+    """
+    :return: (mean, std) of a feature from the statistics file of the user config, or the given defaults
+    """
+    statistics = load_statistics(user_config)
+    if statistics is None:
+        return default_mean, default_std
+    feature_stats = statistics["features"][feature]
+    return feature_stats["mean"], feature_stats["std"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("admin_cfg_path", type=str,
+                        help="path to the JSON config file holding the dataframe path, period and stations")
+    parser.add_argument("-o", "--output_path", type=str, default="../data/statistics.json",
+                        help="path of the JSON file the statistics are saved to")
+    parser.add_argument("-f", "--frame_fraction", type=float, default=1.0,
+                        help="fraction of the frames to use, sampled at random (approximate statistics)")
+    parser.add_argument("-p", "--pixel_stride", type=int, default=1,
+                        help="use every n-th pixel row and column of the frames (approximate statistics)")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="number of worker processes")
+    parser.add_argument("--random_seed", type=int, default=0,
+                        help="seed of the frame sampling")
+    args = parser.parse_args()
+    compute_statistics(
+        admin_config_path=args.admin_cfg_path,
+        output_path=args.output_path,
+        frame_fraction=args.frame_fraction,
+        pixel_stride=args.pixel_stride,
+        workers=args.workers,
+        random_seed=args.random_seed,
+    )
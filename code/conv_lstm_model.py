@@ -1,13 +1,17 @@
 import typing
 import datetime
-import numpy as np
 import tensorflow as tf
 from model_logging import get_logger
 from training_loop import k_to_true_ghi
+from compute_statistics import get_feature_normalization
 
 
 class MainModel(tf.keras.Model):
     TRAINING_REQUIRED = True
+    # inputs read by the DataLoader (see data_loader.INPUT_NAMES)
+    REQUIRED_INPUTS = ("images", "clearsky_GHI", "station_id_onehot", "date_vector")
+    # inputs unused when training on image data only
+    IMAGE_ONLY_UNUSED_INPUTS = ()
 
     def __init__(
             self,
@@ -24,7 +28,8 @@ class MainModel(tf.keras.Model):
                 parameters are loaded automatically if the user provided a JSON file in their submission. Submitting
                 such a JSON file is completely optional, and this argument can be ignored if not needed.
         """
-        super(MainModel, self).__init__()
+        # the inputs and the k -> GHI conversion stay in float32 whatever the precision policy of the layers
+        super(MainModel, self).__init__(dtype="float32")
         self.stations = stations
         self.target_time_offsets = target_time_offsets
         self.config = config
@@ -36,6 +41,13 @@ class MainModel(tf.keras.Model):
         self.logger = get_logger()
         self.logger.debug("Model start")
 
+        # the layers below compute in the precision policy set by the caller (see training_loop.set_precision_policy);
+        # BatchNormalization keeps float32 statistics and normalizes in float32, and the output layer is kept in float32
+
+        # Refer to report for the default mean/std choices
+        self.clearsky_mean, self.clearsky_std = \
+            get_feature_normalization(self.config, "clearsky_GHI", default_mean=454.5, default_std=293.9)
+
         nb_channels = self.config["nb_channels"]
         image_size_m = self.config["image_size_m"]
         image_size_n = self.config["image_size_n"]
@@ -101,10 +113,13 @@ class MainModel(tf.keras.Model):
         self.dropout1 = tf.keras.layers.Dropout(rate=self.config["dropout_rate"])
 
         self.flatten_5 = tf.keras.layers.Flatten()
-        self.lstm_6_1 = tf.keras.layers.LSTM(units=384, return_sequences=True, recurrent_activation=tf.nn.relu)
-        self.lstm_6_2 = tf.keras.layers.LSTM(units=256, recurrent_activation=tf.nn.relu)
+        # "unroll_lstm" unrolls the LSTMs over the input_seq_length frames, e.g. for the TFLite export
+        unroll = self.config.get("unroll_lstm", False)
+        self.lstm_6_1 = tf.keras.layers.LSTM(units=384, return_sequences=True, recurrent_activation=tf.nn.relu,
+                                             unroll=unroll)
+        self.lstm_6_2 = tf.keras.layers.LSTM(units=256, recurrent_activation=tf.nn.relu, unroll=unroll)
         self.dense_7 = tf.keras.layers.Dense(self.config["nb_dense_units"], activation=tf.nn.relu)
-        self.dense_8 = tf.keras.layers.Dense(4, activation=tf.nn.sigmoid)
+        self.dense_8 = tf.keras.layers.Dense(4, activation=tf.nn.sigmoid, dtype="float32")
 
     def cnn_forward(self, img):
         # print(img.shape)
@@ -140,9 +155,10 @@ class MainModel(tf.keras.Model):
         # print(x.shape)
         return x
 
-    def call(self, inputs):
+    def call(self, inputs, training=False, use_image_data_only=False):
         '''
         Defines the forward pass through our model
+        use_image_data_only is ignored: the model always uses all its inputs (see IMAGE_ONLY_UNUSED_INPUTS)
         '''
         # images = tf.squeeze(inputs[0])
         images = inputs[0]
@@ -154,36 +170,21 @@ class MainModel(tf.keras.Model):
         station_id_onehot = (inputs[4])
         date_sin_cos_vector = (inputs[5])
 
-        # Refer to report for mean/std choices
-        normalized_clearsky_GHIs = (clearsky_GHIs - 454.5) / 293.9
-
-        # print("harman: ", images.shape)
-        # assert not np.isnan(images).any()
-
-        img1 = images[:, 0, :, :, :]
-        img2 = images[:, 1, :, :, :]
-        img3 = images[:, 2, :, :, :]
-        # img4 = images[:, 3, :, :, :]
-        # img5 = images[:, 4, :, :, :]
+        normalized_clearsky_GHIs = (clearsky_GHIs - self.clearsky_mean) / self.clearsky_std
 
-        # img1 = images[0, :, :, :]
-        # img2 = images[1, :, :, :]
-        # img3 = images[2, :, :, :]
-
-        x1 = self.cnn_forward(img1)
-        x2 = self.cnn_forward(img2)
-        x3 = self.cnn_forward(img3)
-        # x4 = self.cnn_forward(img4)
-        # x5 = self.cnn_forward(img5)
-
-        x = tf.stack([x1, x2, x3], axis=1)
+        # the frames of all the sequences are encoded by a single batched cnn_forward call, then split back into
+        # sequences of input_seq_length frames for the LSTM
+        seq_length = images.shape[1]
+        x = self.cnn_forward(tf.reshape(images, (-1,) + tuple(images.shape[2:])))
+        x = tf.reshape(x, (-1, seq_length, x.shape[-1]))
         # print(x.shape)
         x = self.lstm_6_1(x)
         # print(x.shape)
         x = self.lstm_6_2(x)
 
         # print("Harman: ",x.shape, date_sin_cos_vector.shape, normalized_clearsky_GHIs.shape)
-        x = tf.concat((x, station_id_onehot, date_sin_cos_vector, normalized_clearsky_GHIs), axis=1)
+        features = tf.concat((station_id_onehot, date_sin_cos_vector, normalized_clearsky_GHIs), axis=1)
+        x = tf.concat((x, tf.cast(features, x.dtype)), axis=1)
         # print(x.shape)
 
         x = self.dense_7(x)
@@ -193,8 +194,6 @@ class MainModel(tf.keras.Model):
         x = self.dropout1(x)
         k = self.dense_8(x)
 
-        assert not np.isnan(k).any()
-
         y = k_to_true_ghi(self.max_k_ghi, k, clearsky_GHIs)
 
         if self.return_ghi_only:
@@ -5,10 +5,17 @@ import pandas as pd
 import numpy as np
 import h5py
 import utils
+import compute_statistics
 import os
 import tqdm
 import json
 import multiprocessing
+import collections
+import glob
+import hashlib
+import shutil
+import tempfile
+import time
 
 
 def get_stations_coordinates(stations) -> typing.Dict[str, typing.Tuple]:
@@ -31,9 +38,12 @@ def get_stations_coordinates(stations) -> typing.Dict[str, typing.Tuple]:
 
 
 def preprocess_dataframe(dataframe: pd.DataFrame,
-                         stations: typing.Dict[str, typing.Tuple]
+                         stations: typing.Dict[str, typing.Tuple],
+                         random_state: typing.Optional[int] = None,
+                         group_by_file: bool = False
     ) -> pd.DataFrame:
     """
+    :param group_by_file: order rows by source HDF5 file and offset instead of shuffling them
     :return: preprocessed pd.Dataframe 
     """
     main_df = dataframe.copy()
@@ -62,8 +72,12 @@ def preprocess_dataframe(dataframe: pd.DataFrame,
                          & (main_df[b[5]] == 0.0)
                          & (main_df[b[6]] == 0.0)].index, inplace=True)
 
-    # shuffle dataframe
-    main_df = main_df.sample(frac=1)
+    if group_by_file:
+        # sequential reads over the satellite archive; samples are shuffled afterwards (see shuffle_shard_index)
+        main_df = main_df.sort_values(["hdf5_8bit_path", "hdf5_8bit_offset"], kind="mergesort")
+    else:
+        # shuffle dataframe (with a fixed seed, slices must be identical between runs to be resumed)
+        main_df = main_df.sample(frac=1, random_state=random_state)
 
     return main_df
 
@@ -74,6 +88,219 @@ def load_file(path, name):
         return json.load(fd)
 
 
+# version stored in the "layout_version" attribute of compact batch files (legacy files have no such attribute)
+COMPACT_LAYOUT_VERSION = 3
+
+# sharded layout: a few large shard files plus an index of all their samples
+SHARD_FILE_PREFIX = "shard_"
+SHARD_INDEX_FILE_NAME = "index.hdf5"
+
+
+def get_batch_storage_config(user_config, admin_config):
+    """
+    :return: storage layout parameters of the batch files, taken from the user config
+    """
+    channel_means, channel_stds = get_channel_normalization(user_config)
+    return {
+        # "legacy": float32 images, string datetimes and station IDs; "compact": chunked, compressed and typed;
+        # "sharded": compact layout appended to one shard file per slice, plus an index of all the samples
+        "layout": user_config.get("batch_file_layout", "legacy"),
+        # one of "gzip", "lzf", "lz4" or "blosc" (the last two require the hdf5plugin package), or None
+        "compression": user_config.get("batch_file_compression", "lzf"),
+        # one of "uint8", "float16" or "float32"
+        "image_dtype": user_config.get("batch_file_image_dtype", "float16"),
+        # station IDs are stored as their index in this list
+        "station_names": list(admin_config["stations"].keys()),
+        # standardization of the images, from the statistics file of the user config if any
+        "channel_means": channel_means.tolist(),
+        "channel_stds": channel_stds.tolist(),
+    }
+
+
+def get_compression_kwargs(compression):
+    """
+    :return: keyword arguments of h5py's create_dataset for the given compression filter
+    """
+    if not compression:
+        return {}
+    if compression in ["gzip", "lzf"]:
+        return {"compression": compression}
+    assert compression in ["lz4", "blosc"], f"unrecognized batch file compression '{compression}'"
+    # the lz4 and blosc HDF5 filters are provided by the optional hdf5plugin package
+    import hdf5plugin
+    if compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    return dict(hdf5plugin.Blosc(cname="lz4", shuffle=hdf5plugin.Blosc.SHUFFLE))
+
+
+def quantize_images(images, image_dtype):
+    """
+    :return: images cast to image_dtype, and the attributes required to restore them as float32
+    """
+    if image_dtype == "float32" or image_dtype == "float16":
+        return images.astype(image_dtype), {}
+    assert image_dtype == "uint8", f"unrecognized batch file image dtype '{image_dtype}'"
+    # linear per-channel quantization between the min and max values of the batch
+    channel_axes = tuple(range(images.ndim - 1))
+    offset = images.min(axis=channel_axes).astype(np.float32)
+    scale = ((images.max(axis=channel_axes) - offset) / 255).astype(np.float32)
+    scale[scale == 0] = 1
+    quantized = np.round((images - offset) / scale).astype(np.uint8)
+    return quantized, {"quantization_offset": offset, "quantization_scale": scale}
+
+
+def encode_compact_batch(image_data,
+                         true_ghis_data,
+                         clear_sky_ghis_data,
+                         station_ids,
+                         datetime_sequence,
+                         night_time_flags,
+                         storage_config):
+    """
+    :return: dictionnary of dataset name -> typed array of a batch in the compact layout, and the attributes
+    required to restore the images as float32
+    """
+    images, images_attrs = quantize_images(image_data, storage_config["image_dtype"])
+    station_names = storage_config["station_names"]
+    station_codes = [station_names.index(n) for n in station_ids]
+    # station specific date of T0, in seconds since the epoch
+    datetime_sequence = pd.DatetimeIndex(datetime_sequence).values.astype('datetime64[s]').astype(np.int64)
+
+    datasets = {
+        "images": images,
+        "GHI": true_ghis_data.astype(np.float32),
+        "clearsky_GHI": clear_sky_ghis_data.astype(np.float32),
+        "night_flags": night_time_flags.astype(np.uint8),
+        "station_id": np.array(station_codes, dtype=np.uint8),
+        "datetime_sequence": datetime_sequence,
+        # precomputed so that the DataLoader does not derive them from the datetimes at every epoch
+        "time_features": utils.get_time_features(datetime_sequence),
+    }
+    return datasets, images_attrs
+
+
+def write_compact_attrs(f, storage_config):
+    """
+    Writes the file attributes shared by compact batch files and shards
+    """
+    f.attrs["layout_version"] = COMPACT_LAYOUT_VERSION
+    f.attrs["station_names"] = np.array([n.encode("ascii", "ignore") for n in storage_config["station_names"]])
+    # normalization parameters that were applied to the images
+    f.attrs["channel_means"] = np.array(storage_config["channel_means"], dtype=np.float32)
+    f.attrs["channel_stds"] = np.array(storage_config["channel_stds"], dtype=np.float32)
+
+
+def save_compact_batch(path,
+                       image_data,
+                       true_ghis_data,
+                       clear_sky_ghis_data,
+                       station_ids,
+                       datetime_sequence,
+                       night_time_flags,
+                       storage_config):
+    """
+    This function saves a batch in the compact layout: images are stored in per-sample compressed chunks as
+    uint8/float16, datetimes as int64 epoch seconds and station IDs as indices in the "station_names" attribute
+    """
+    compression_kwargs = get_compression_kwargs(storage_config["compression"])
+    datasets, images_attrs = encode_compact_batch(image_data, true_ghis_data, clear_sky_ghis_data, station_ids,
+                                                  datetime_sequence, night_time_flags, storage_config)
+    with h5py.File(path, 'w') as f:
+        write_compact_attrs(f, storage_config)
+
+        images = datasets.pop("images")
+        images_dataset = f.create_dataset("images", data=images, chunks=(1,) + images.shape[1:], **compression_kwargs)
+        images_dataset.attrs.update(images_attrs)
+
+        for name, data in datasets.items():
+            f.create_dataset(name, data=data)
+        f["datetime_sequence"].attrs["units"] = "seconds since 1970-01-01 00:00:00"
+
+
+class ShardWriter():
+    """
+    Appends batches of samples to a shard: a single large file of resizable datasets in the compact layout.
+    uint8 images are quantized per flushed batch, their scale/offset being stored per sample in the
+    "images_quantization_scale" and "images_quantization_offset" datasets
+    """
+
+    def __init__(self, path, storage_config):
+        self.path = path
+        self.storage_config = storage_config
+
+    def append(self,
+               image_data,
+               true_ghis_data,
+               clear_sky_ghis_data,
+               station_ids,
+               datetime_sequence,
+               night_time_flags):
+        datasets, images_attrs = encode_compact_batch(image_data, true_ghis_data, clear_sky_ghis_data, station_ids,
+                                                      datetime_sequence, night_time_flags, self.storage_config)
+        nb_samples = len(image_data)
+        for name, value in images_attrs.items():
+            datasets["images_" + name] = np.broadcast_to(value, (nb_samples,) + value.shape)
+
+        # the shard is reopened for every batch so that it is always left in a consistent state
+        with h5py.File(self.path, 'a') as f:
+            if "images" not in f:
+                write_compact_attrs(f, self.storage_config)
+                compression_kwargs = get_compression_kwargs(self.storage_config["compression"])
+                for name, data in datasets.items():
+                    chunks = (1,) + data.shape[1:] if name == "images" else True
+                    f.create_dataset(name, shape=(0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                                     dtype=data.dtype, chunks=chunks, **compression_kwargs)
+                f["datetime_sequence"].attrs["units"] = "seconds since 1970-01-01 00:00:00"
+
+            start = f["images"].shape[0]
+            for name, data in datasets.items():
+                f[name].resize(start + nb_samples, axis=0)
+                f[name][start:] = data
+
+
+def shuffle_shard_index(dir_path, random_seed):
+    """
+    Shuffle stage of a sharded dataset: permutes the samples of its index, which defines the order in which
+    the DataLoader reads them
+    """
+    index_path = os.path.join(dir_path, SHARD_INDEX_FILE_NAME)
+    with h5py.File(index_path, 'r+') as f:
+        permutation = np.random.RandomState(random_seed).permutation(f["shard"].shape[0])
+        for name in ["shard", "row", "datetime_sequence", "station_id"]:
+            f[name][...] = f[name][()][permutation]
+        f.attrs["shuffle_seed"] = random_seed
+    print("Shuffled {} samples".format(len(permutation)))
+
+
+def build_shard_index(dir_path):
+    """
+    Creates the index of a sharded dataset, mapping every sample to its shard, row, T0 datetime and station
+    """
+    shard_files = sorted(os.path.basename(p) for p in glob.glob(os.path.join(dir_path, SHARD_FILE_PREFIX + "*.hdf5")))
+    shards, rows, datetimes, station_ids = [], [], [], []
+    station_names = None
+    for shard_idx, shard_file in enumerate(shard_files):
+        with h5py.File(os.path.join(dir_path, shard_file), 'r') as f:
+            if "station_id" not in f:
+                continue
+            station_names = f.attrs["station_names"]
+            nb_samples = f["station_id"].shape[0]
+            shards.append(np.full(nb_samples, shard_idx, dtype=np.int32))
+            rows.append(np.arange(nb_samples, dtype=np.int64))
+            datetimes.append(f["datetime_sequence"][()])
+            station_ids.append(f["station_id"][()])
+
+    with h5py.File(os.path.join(dir_path, SHARD_INDEX_FILE_NAME), 'w') as f:
+        f.attrs["shard_files"] = np.array([n.encode("ascii", "ignore") for n in shard_files])
+        if station_names is not None:
+            f.attrs["station_names"] = station_names
+        f.create_dataset("shard", data=np.concatenate(shards) if shards else np.zeros(0, dtype=np.int32))
+        f.create_dataset("row", data=np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64))
+        f.create_dataset("datetime_sequence", data=np.concatenate(datetimes) if datetimes else np.zeros(0, np.int64))
+        f.create_dataset("station_id", data=np.concatenate(station_ids) if station_ids else np.zeros(0, np.uint8))
+    print("Indexed {} samples in {} shards".format(sum(len(s) for s in shards), len(shards)))
+
+
 def save_image_and_batch(dir_path,
                          file_name,
                          image_data,
@@ -81,12 +308,18 @@ def save_image_and_batch(dir_path,
                          clear_sky_ghis_data,
                          station_ids,
                          datetime_sequence,
-                         night_time_flags):
+                         night_time_flags,
+                         storage_config=None):
     """
     This function saves images, true GHI, clearsky_GHI, night_flags, and stations_ids in .h5 file  
     """
     file_name = file_name + ".hdf5"
     path = os.path.join(dir_path, file_name)
+    if storage_config is not None and storage_config["layout"] == "compact":
+        save_compact_batch(path, image_data, true_ghis_data, clear_sky_ghis_data, station_ids, datetime_sequence,
+                           night_time_flags, storage_config)
+        return
+
     with h5py.File(path, 'w') as f:
         f.create_dataset("images", shape=image_data.shape, dtype=np.float32, data=image_data)
         f.create_dataset("GHI", shape=true_ghis_data.shape, dtype=np.float32, data=true_ghis_data)
@@ -100,204 +333,290 @@ def save_image_and_batch(dir_path,
         f.create_dataset("datetime_sequence", shape=(len(datetime_sequence), 1), dtype='S100', data=datetime_sequence)
 
 
-def get_channels(hdf5_path, hdf5_offset):
+def get_channels(hdf5_path, hdf5_offset, window=None):
     """
-    :return: all the channels for a particular offset
+    :param window: optional (row_start, row_stop, col_start, col_stop) window of the frame to read
+    :return: all the channels for a particular offset, or their window
     """
-    with h5py.File(hdf5_path, "r") as h5_data:
-        ch1_data = utils.fetch_hdf5_sample("ch1", h5_data, hdf5_offset)
-        ch2_data = utils.fetch_hdf5_sample("ch2", h5_data, hdf5_offset)
-        ch3_data = utils.fetch_hdf5_sample("ch3", h5_data, hdf5_offset)
-        ch4_data = utils.fetch_hdf5_sample("ch4", h5_data, hdf5_offset)
-        ch6_data = utils.fetch_hdf5_sample("ch6", h5_data, hdf5_offset)
-    return ch1_data, ch2_data, ch3_data, ch4_data, ch6_data
+    # the archive is kept open in the reader pool since the same daily file is used by many samples
+    with utils.open_hdf5(hdf5_path) as h5_data:
+        if window is None:
+            return tuple(utils.fetch_hdf5_sample(name, h5_data, hdf5_offset)
+                         for name in compute_statistics.CHANNEL_NAMES)
+        return tuple(utils.fetch_hdf5_window(name, h5_data, hdf5_offset, window)
+                     for name in compute_statistics.CHANNEL_NAMES)
 
 
-def get_TrueGHIs(dataframe, target_time_offsets, timestamp, station_id, is_eval=False):
-    """ 
-    :return: list of true GHIs for T0, T1, T3, T6
-    """
-    if not is_eval:
-        # check if its night at this station
-        DAYTIME_col = station_id + "_DAYTIME"
-        # return None if T0 time isn't daytime, we don't want to train on such sequences
-        if dataframe.loc[timestamp][DAYTIME_col] == 0.0:
-            return None
-
-    trueGHIs = [0] * 4
-    GHI_col = station_id + "_GHI"
-    clearSkyGHI_col = station_id + "_CLEARSKY_GHI"
-
-    # if timestamp missing
-    # using clearsky value to interpolate
-    try:
-        trueGHIs[0] = dataframe.loc[timestamp][GHI_col]  # T0_GHI
-    except Exception as _:
-        try:
-            trueGHIs[0] = dataframe.loc[timestamp + target_time_offsets[0]][clearSkyGHI_col]
-        except Exception as _:
-            trueGHIs[0] = 0
-
-    try:
-        trueGHIs[1] = dataframe.loc[timestamp + target_time_offsets[1]][GHI_col]  # T1_GHI
-    except Exception as _:
-        try:
-            trueGHIs[1] = dataframe.loc[timestamp + target_time_offsets[1]][clearSkyGHI_col]
-        except Exception as _:
-            pass
+class FrameCache():
+    """
+    Memory-bounded LRU cache of decoded channel stacks, keyed by (hdf5_path, hdf5_offset, window), so that each
+    satellite frame shared by several history sequences is decompressed only once per process
+    """
 
-    try:
-        trueGHIs[2] = dataframe.loc[timestamp + target_time_offsets[2]][GHI_col]  # T3_GHI
-    except Exception as _:
-        try:
-            trueGHIs[2] = dataframe.loc[timestamp + target_time_offsets[2]][clearSkyGHI_col]
-        except Exception as _:
-            pass
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.frames = collections.OrderedDict()
+
+    def get(self, hdf5_path, hdf5_offset, window=None):
+        """
+        :param window: optional (row_start, row_stop, col_start, col_stop) window of the frame to read
+        :return: read-only (5, H, W) array of the decoded channels of a frame, or of its window
+        """
+        key = (hdf5_path, int(hdf5_offset), window)
+        if key in self.frames:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+        self.misses += 1
+        frame = np.stack(get_channels(hdf5_path, hdf5_offset, window))
+        # frames are shared between samples, they must never be modified in place
+        frame.flags.writeable = False
+
+        self.frames[key] = frame
+        self.nbytes += frame.nbytes
+        # always keep the last frame, even if it is bigger than the whole budget
+        while self.nbytes > self.max_bytes and len(self.frames) > 1:
+            _, evicted_frame = self.frames.popitem(last=False)
+            self.nbytes -= evicted_frame.nbytes
+        return frame
+
+    def stats(self):
+        """
+        :return: dictionnary of hit/miss counters and memory usage of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "frames": len(self.frames),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class BatchBuffer():
+    """
+    Fixed-capacity accumulation buffer for the samples of a batch file. Samples are written in place into
+    arrays preallocated on the first append, and the buffer is flushed through ``flush_fn`` every time it is
+    full; samples that did not fit are carried over to the next batch
+    """
 
-    try:
-        trueGHIs[3] = dataframe.loc[timestamp + target_time_offsets[3]][GHI_col]  # T6_GHI
-    except Exception as _:
-        try:
-            trueGHIs[3] = dataframe.loc[timestamp + target_time_offsets[3]][clearSkyGHI_col]
-        except Exception as _:
-            pass
+    def __init__(self, capacity, flush_fn):
+        self.capacity = capacity
+        self.flush_fn = flush_fn
+        self.size = 0
+        self.arrays = None
+
+    def append(self, *arrays):
+        """
+        Writes the samples of the given arrays (all with the same first dimension) into the buffer
+        """
+        nb_samples = len(arrays[0])
+        assert all(len(array) == nb_samples for array in arrays)
+        if nb_samples == 0:
+            return
+        if self.arrays is None:
+            self.arrays = [np.empty((self.capacity,) + np.shape(array)[1:], dtype=np.asarray(array).dtype)
+                           for array in arrays]
+
+        start = 0
+        while start < nb_samples:
+            count = min(nb_samples - start, self.capacity - self.size)
+            for buffer_array, array in zip(self.arrays, arrays):
+                buffer_array[self.size:self.size + count] = array[start:start + count]
+            self.size += count
+            start += count
+            if self.size == self.capacity:
+                self.flush()
+
+    def flush(self):
+        """
+        Passes the buffered samples to ``flush_fn`` and empties the buffer
+        """
+        if self.size == 0:
+            return
+        self.flush_fn(*[buffer_array[:self.size] for buffer_array in self.arrays])
+        self.size = 0
+
+
+# per-process decoded frame cache, shared by all the slices processed by a worker
+_frame_cache = None
+
+
+def get_frame_cache(user_config):
+    """
+    :return: the FrameCache of the current process, sized with the "frame_cache_size_mb" user config (in MB)
+    """
+    global _frame_cache
+    max_bytes = int(user_config.get("frame_cache_size_mb", 1024) * 1024 ** 2)
+    if _frame_cache is None or _frame_cache.max_bytes != max_bytes:
+        _frame_cache = FrameCache(max_bytes)
+    return _frame_cache
 
-    # if we still encounter NaN, handle it
-    if np.any(np.isnan(trueGHIs)):
-        return None
 
-    return trueGHIs
+def build_label_table(dataframe, t0_timestamps, station_ids, target_time_offsets, is_eval=False):
+    """
+    Vectorized replacement of the per-row true GHI / clearsky GHI / daytime flag lookups.
 
+    Every T0 is aligned on the catalog index once per target offset, and the same fallback rules as the
+    original lookups are applied column-wise: a missing true GHI row gives 0, a missing clearsky GHI row falls
+    back to the previous offset (then 0 for T0 and 1 for later offsets), a missing daytime row gives 1.
+    Any NaN left in a station sequence replaces the whole sequence by ones (dummy targets).
 
-def get_ClearSkyGHIs(dataframe, target_time_offsets, timestamp, station_id, is_eval=False):
+    :return: dictionnary holding the T0 index and dense (n_timestamps, n_stations, n_offsets) float32 arrays
+    for "GHI", "clearsky_GHI" and "night_flags", plus the (n_timestamps, n_stations) T0 "daytime" flags
     """
-    :return: list of clear sky GHI's for T0, T1, T3, T6 
-    """
-    if not is_eval:
-        # check if its night at this station
-        DAYTIME_col = station_id + "_DAYTIME"
-        # return None if T0 time isn't daytime, we don't want to train on such sequences
-        if dataframe.loc[timestamp][DAYTIME_col] == 0.0:
-            return None
+    t0_index = pd.DatetimeIndex(t0_timestamps)
+    n_timestamps, n_stations, n_offsets = len(t0_index), len(station_ids), len(target_time_offsets)
+
+    # row of T0 + offset in the catalog, -1 if the catalog has no such row
+    positions = np.stack([dataframe.index.get_indexer(t0_index + offset) for offset in target_time_offsets], axis=1)
+    found = positions >= 0
+    positions = np.where(found, positions, 0)
+
+    # clearsky GHI of a missing offset falls back to the previous one (T0 falls back to itself)
+    fallback_offsets = np.maximum(np.arange(n_offsets) - 1, 0)
+    fallback_found = found[:, fallback_offsets]
+    fallback_positions = positions[:, fallback_offsets]
+    clearsky_defaults = np.ones(n_offsets)
+    clearsky_defaults[0] = 0
+
+    t0_positions = dataframe.index.get_indexer(t0_index)
+
+    true_ghis = np.zeros((n_timestamps, n_stations, n_offsets), dtype=np.float32)
+    clearsky_ghis = np.ones((n_timestamps, n_stations, n_offsets), dtype=np.float32)
+    night_flags = np.ones((n_timestamps, n_stations, n_offsets), dtype=np.float32)
+    daytime = np.full((n_timestamps, n_stations), np.nan, dtype=np.float32)
+
+    for station_idx, station_id in enumerate(station_ids):
+        daytime_col = dataframe[station_id + "_DAYTIME"].to_numpy(dtype=np.float64)
+        clearsky_col = dataframe[station_id + "_CLEARSKY_GHI"].to_numpy(dtype=np.float64)
+
+        daytime[t0_positions >= 0, station_idx] = daytime_col[t0_positions[t0_positions >= 0]]
+
+        # we don't need GHIs during evaluation
+        if not is_eval:
+            ghi_col = dataframe[station_id + "_GHI"].to_numpy(dtype=np.float64)
+            station_ghis = np.where(found, ghi_col[positions], 0)
+            valid = ~np.isnan(station_ghis).any(axis=1)
+            true_ghis[valid, station_idx] = station_ghis[valid]
+            # setup dummy GHIs for invalid sequences
+            true_ghis[~valid, station_idx] = 1
+
+        station_clearsky_ghis = np.where(
+            found,
+            clearsky_col[positions],
+            np.where(fallback_found, clearsky_col[fallback_positions], clearsky_defaults)
+        )
+        valid = ~np.isnan(station_clearsky_ghis).any(axis=1)
+        clearsky_ghis[valid, station_idx] = station_clearsky_ghis[valid]
 
-    clearSkyGHIs = [0] * 4
-    clearSkyGHI_col = station_id + "_CLEARSKY_GHI"
-    # if timestamp missing
-    try:
-        clearSkyGHIs[0] = dataframe.loc[timestamp][clearSkyGHI_col]  # T0_GHI
-    except Exception as _:
-        try:
-            clearSkyGHIs[0] = dataframe.loc[timestamp + target_time_offsets[0]][clearSkyGHI_col]
-        except Exception as _:
-            clearSkyGHIs[0] = 0
+        station_night_flags = np.where(found, daytime_col[positions], 1.0)
+        valid = ~np.isnan(station_night_flags).any(axis=1)
+        night_flags[valid, station_idx] = station_night_flags[valid]
 
-    try:
-        clearSkyGHIs[1] = dataframe.loc[timestamp + target_time_offsets[1]][clearSkyGHI_col]  # T1_GHI
-    except Exception as _:
-        try:
-            clearSkyGHIs[1] = dataframe.loc[timestamp + target_time_offsets[0]][clearSkyGHI_col]
-        except Exception as _:
-            clearSkyGHIs[1] = 1
+    return {
+        "index": t0_index,
+        "GHI": true_ghis,
+        "clearsky_GHI": clearsky_ghis,
+        "night_flags": night_flags,
+        "daytime": daytime,
+    }
 
-    try:
-        clearSkyGHIs[2] = dataframe.loc[timestamp + target_time_offsets[2]][clearSkyGHI_col]  # T3_GHI
-    except Exception as _:
-        try:
-            clearSkyGHIs[2] = dataframe.loc[timestamp + target_time_offsets[1]][clearSkyGHI_col]
-        except Exception as _:
-            clearSkyGHIs[2] = 1
 
-    try:
-        clearSkyGHIs[3] = dataframe.loc[timestamp + target_time_offsets[3]][clearSkyGHI_col]  # T6_GHI
-    except Exception as _:
-        try:
-            clearSkyGHIs[3] = dataframe.loc[timestamp + target_time_offsets[2]][clearSkyGHI_col]
-        except Exception as _:
-            clearSkyGHIs[3] = 1
+def get_station_specific_time(timestamp, station_id, time_zone_mapping):
+    return timestamp - time_zone_mapping[station_id]
 
-    # if we still encounter NaN, handle it
-    if np.any(np.isnan(clearSkyGHIs)):
-        return None
 
-    return clearSkyGHIs
+# default per-channel (ch1, ch2, ch3, ch4, ch6) statistics used to standardize the images
+CHANNEL_MEANS = np.array([0.30, 272.52, 236.94, 261.47, 247.28], dtype=np.float32)
+CHANNEL_STDS = np.array([0.218, 13.66, 6.49, 15.91, 11.15], dtype=np.float32)
 
 
-def get_night_time_flags(dataframe, target_time_offsets, timestamp, station_id, is_eval=False):
+def get_channel_normalization(user_config):
     """
-    :return: list of daytime flags for T0, T1, T3, T6
+    :return: per-channel means and standard deviations of the statistics file of the user config (see
+    compute_statistics.py), or the default ones
     """
-    # check if its night at this station
-    DAYTIME_col = station_id + "_DAYTIME"
-
-    if not is_eval:
-        # return None if T0 time isn't daytime, we don't want to train on such sequences
-        if dataframe.loc[timestamp][DAYTIME_col] == 0.0:
-            return None
+    statistics = compute_statistics.load_statistics(user_config)
+    if statistics is None:
+        return CHANNEL_MEANS, CHANNEL_STDS
+    channels = statistics["channels"]
+    assert channels["names"] == compute_statistics.CHANNEL_NAMES, f"unexpected channels {channels['names']}"
+    return np.array(channels["mean"], dtype=np.float32), np.array(channels["std"], dtype=np.float32)
 
-    night_time_flags = [1.0] * 4
-    # if timestamp missing
-    try:
-        night_time_flags[0] = dataframe.loc[timestamp][DAYTIME_col]  # T0_GHI
-    except Exception as _:
-        night_time_flags[0] = 1.0
-    try:
-        night_time_flags[1] = dataframe.loc[timestamp + target_time_offsets[1]][DAYTIME_col]  # T1_GHI
-    except Exception as _:
-        night_time_flags[1] = 1.0
-
-    try:
-        night_time_flags[2] = dataframe.loc[timestamp + target_time_offsets[2]][DAYTIME_col]  # T3_GHI
-    except Exception as _:
-        night_time_flags[2] = 1.0
-
-    try:
-        night_time_flags[3] = dataframe.loc[timestamp + target_time_offsets[3]][DAYTIME_col]  # T6_GHI
-    except Exception as _:
-        night_time_flags[3] = 1.0
-
-    # if we still encounter NaN, handle it
-    if np.any(np.isnan(night_time_flags)):
-        return None
-
-    return night_time_flags
 
+def normalize_images(images, channel_means=CHANNEL_MEANS, channel_stds=CHANNEL_STDS):
+    """ 
+    Standardize the images with mean 0 and variance 1, channels being the last axis
+    """
+    return (images - channel_means) / channel_stds
 
-def get_station_specific_time(timestamp, station_id, time_zone_mapping):
-    return timestamp - time_zone_mapping[station_id]
 
+def crop_stations(frame, stations_pixels, window_size, channel_means=CHANNEL_MEANS, channel_stds=CHANNEL_STDS):
+    """
+    Extracts the windows of all the stations from a decoded frame in a single gather.
+    Windows overlapping the image border are padded by repeating the border pixels.
 
-def normalize_images(images):
-    """ 
-    Standardize the images with mean 0 and variance 1
+    :param frame: (n_channels, H, W) array of decoded channels
+    :param stations_pixels: (n_stations, 2) array of station (coord_x, coord_y) pixel coordinates
+    :return: (n_stations, 2 * window_size, 2 * window_size, n_channels) array of normalized crops
     """
-    means = [0.30, 272.52, 236.94, 261.47, 247.28]
-    stds = [0.218, 13.66, 6.49, 15.91, 11.15]
+    n_channels, height, width = frame.shape
+    offsets = np.arange(-window_size, window_size)
+    rows = np.clip(stations_pixels[:, 0, None] + offsets, 0, height - 1)
+    cols = np.clip(stations_pixels[:, 1, None] + offsets, 0, width - 1)
+    flat_indices = rows[:, :, None] * width + cols[:, None, :]
 
-    for channel, u, sig in zip(range(5), means, stds):
-        images[:, :, channel] = (images[:, :, channel] - u) / sig
-    return images
+    crops = frame.reshape(n_channels, height * width)[:, flat_indices]
+    return normalize_images(np.moveaxis(crops, 0, -1), channel_means, channel_stds)
 
 
 def crop_images(df,
-                big_df,
+                label_table,
+                label_idx,
                 timestamps_from_history,
-                target_time_offsets,
                 coordinates,
                 window_size,
                 time_zone_mapping,
-                is_eval):
+                is_eval,
+                frame_cache,
+                channel_means=CHANNEL_MEANS,
+                channel_stds=CHANNEL_STDS,
+                window_reads=True):
     """ 
+    :param window_reads: only read the bounding box of the station windows from the frames instead of full frames
     :return: multiple arrays corresponding to cropped images, true GHIs, clearsky GHIs,
     station IDs, T0 timestamp, nighttime flags
     """
     assert window_size < 42, f"window_size value of {window_size} is too big, please reduce it to 42 and lower"
 
+    station_ids = np.array(list(coordinates.keys()))
+    stations_pixels = np.array(list(coordinates.values()), dtype=np.int64).reshape(-1, 2)
+
+    frame_window = None
+    if window_reads:
+        # bounding box of the windows of all the stations, whether considered or not, so that the same frame
+        # windows are cached for all the samples; the crops are then located relative to its (clipped) origin
+        row_start, col_start = stations_pixels.min(axis=0) - window_size
+        row_stop, col_stop = stations_pixels.max(axis=0) + window_size
+        frame_window = (int(row_start), int(row_stop), int(col_start), int(col_stop))
+        stations_pixels = stations_pixels - np.maximum([row_start, col_start], 0)
+
+    # check if T0 time isn't daytime, we don't want to train on such sequences for that particular station
+    if is_eval:
+        considered_stations = np.ones(len(station_ids), dtype=bool)
+    else:
+        considered_stations = label_table["daytime"][label_idx] != 0.0
+    station_ids = station_ids[considered_stations]
+    stations_pixels = stations_pixels[considered_stations]
+
     image_crops_for_stations = []
-    true_ghis_for_station = []
-    clearSky_ghis_for_station = []
-    station_ids = []
-    considered_timestamps = []
-    night_time_flags_for_station = []
 
     for index, timestamp in enumerate(timestamps_from_history):
         try:
@@ -306,7 +625,7 @@ def crop_images(df,
             if index == 0:
                 print("Timestamp {} not found for station {}, Not considering this sequence! \n".format(timestamp,
                                                                                                         coordinates))
-                return None, None, None, None
+                return None, None, None, None, None, None
             else:
                 # use T0 image if missing
                 row = df.loc[timestamps_from_history[0]]
@@ -314,90 +633,137 @@ def crop_images(df,
         hdf5_path = row["hdf5_8bit_path"]
         hdf5_offset = row["hdf5_8bit_offset"]
 
-        channels_data = get_channels(hdf5_path, hdf5_offset)
+        channels_data = frame_cache.get(hdf5_path, hdf5_offset, frame_window)
 
-        image_crops_per_stations = []
+        # get cropped images for all stations at once
+        image_crops_for_stations.append(crop_stations(channels_data, stations_pixels, window_size, channel_means,
+                                                      channel_stds))
 
-        # get cropped images for stations
-        for _, station_coordinates in enumerate(coordinates.items()):
-
-            station_id = station_coordinates[0]
-            DAYTIME_col = station_id + "_DAYTIME"
-            # check if T0 time isn't daytime, we don't want to train on such sequences for that particular station
-            if not is_eval and df.loc[timestamps_from_history[0]][DAYTIME_col] == 0.0:
-                continue
+    # get true GHIs only for first timestamp - T0
+    t0_timestamp = timestamps_from_history[0]
+    considered_timestamps = [get_station_specific_time(t0_timestamp, station_id, time_zone_mapping)
+                             for station_id in station_ids]
 
-            x_coord = station_coordinates[1][0]
-            y_coord = station_coordinates[1][1]
+    return np.stack(image_crops_for_stations, axis=1), \
+        label_table["GHI"][label_idx, considered_stations], \
+        label_table["clearsky_GHI"][label_idx, considered_stations], \
+        station_ids, \
+        np.array(considered_timestamps), \
+        label_table["night_flags"][label_idx, considered_stations]
 
-            ch1_crop = channels_data[0][x_coord - window_size:x_coord + window_size,
-                                        y_coord - window_size:y_coord + window_size]
-            ch2_crop = channels_data[1][x_coord - window_size:x_coord + window_size,
-                                        y_coord - window_size:y_coord + window_size]
-            ch3_crop = channels_data[2][x_coord - window_size:x_coord + window_size,
-                                        y_coord - window_size:y_coord + window_size]
-            ch4_crop = channels_data[3][x_coord - window_size:x_coord + window_size,
-                                        y_coord - window_size:y_coord + window_size]
-            ch6_crop = channels_data[4][x_coord - window_size:x_coord + window_size,
-                                        y_coord - window_size:y_coord + window_size]
 
-            cropped_img = np.stack((ch1_crop,
-                                    ch2_crop,
-                                    ch3_crop,
-                                    ch4_crop,
-                                    ch6_crop), axis=-1)
+# progress manifest of batch generation: one JSON file per completed slice, so that concurrent workers or runs
+# never write to the same file
+MANIFEST_DIR_NAME = "_manifest"
 
-            cropped_img = normalize_images(cropped_img)
 
-            cropped_img = np.expand_dims(cropped_img, axis=0)
+def get_slice_name(start_index, end_index):
+    return "slice_" + str(start_index).zfill(7) + "_" + str(end_index).zfill(7)
 
-            image_crops_per_stations.append(cropped_img)
 
-            # get true GHIs only for first timestamp - T0
-            if index == 0:
-                trueGHIs = get_TrueGHIs(big_df, target_time_offsets, timestamp, station_id, is_eval)
-                clearSkyGHIs = get_ClearSkyGHIs(big_df, target_time_offsets, timestamp, station_id, is_eval)
-                night_time_flags = get_night_time_flags(big_df, target_time_offsets, timestamp, station_id, is_eval)
-
-                # we don't need GHIs during evaluation
-                if is_eval:
-                    trueGHIs = [0] * 4
-
-                if trueGHIs is None:
-                    # setup dummy GHIs for now!
-                    trueGHIs = np.ones(len(target_time_offsets))
-
-                if clearSkyGHIs is None:
-                    clearSkyGHIs = np.ones(len(target_time_offsets))
-
-                if night_time_flags is None:
-                    night_time_flags = np.ones(len(target_time_offsets))
+def get_slice_fingerprint(slice_df, stations_coordinates, user_config, train_config, storage_config):
+    """
+    :return: hash of everything that determines the content of the batch files of a slice
+    """
+    fingerprint = hashlib.md5(slice_df.index.values.astype('datetime64[s]').astype(np.int64).tobytes())
+    parameters = {
+        "stations": {k: [int(c) for c in v] for k, v in stations_coordinates.items()},
+        "user_config": {k: user_config.get(k) for k in ["input_time_offsets", "input_seq_length", "image_size_m",
+                                                        "time_zone_mapping", "mini_batch_size"]},
+        "target_time_offsets": train_config["target_time_offsets"],
+        "storage_config": storage_config,
+        "layout_version": COMPACT_LAYOUT_VERSION,
+    }
+    fingerprint.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def get_file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(2 ** 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def load_slice_manifest(save_dir_path, slice_name):
+    """
+    :return: the manifest of a completed slice, None if the slice was never completed
+    """
+    manifest_path = os.path.join(save_dir_path, MANIFEST_DIR_NAME, slice_name + ".json")
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r") as fd:
+        return json.load(fd)
 
-                true_ghis_for_station.append(trueGHIs)
-                clearSky_ghis_for_station.append(clearSkyGHIs)
-                # append station id if everything works well till this point
-                station_ids.append(station_id)
-                timestamp_as_per_station_timezone = get_station_specific_time(timestamp, station_id, time_zone_mapping)
-                considered_timestamps.append(timestamp_as_per_station_timezone)
-                night_time_flags_for_station.append(night_time_flags)
 
-        image_crops_per_stations = np.array(image_crops_per_stations)
+def is_slice_complete(save_dir_path, slice_name, fingerprint):
+    """
+    :return: True if the manifest records the slice as completed with the same fingerprint, and all the
+    files it produced are still there with their recorded size and checksum
+    """
+    manifest = load_slice_manifest(save_dir_path, slice_name)
+    if manifest is None or manifest["fingerprint"] != fingerprint:
+        return False
+    for f in manifest["files"]:
+        path = os.path.join(save_dir_path, f["name"])
+        if not os.path.isfile(path) or os.path.getsize(path) != f["bytes"] or get_file_md5(path) != f["md5"]:
+            return False
+    return True
 
-        # image_crops_for_stations.append(image_crops_per_stations)
-        if len(image_crops_for_stations) == 0:
-            image_crops_for_stations = image_crops_per_stations
-        else:
-            image_crops_for_stations = np.concatenate((image_crops_for_stations, image_crops_per_stations), axis=1)
 
-    return np.array(image_crops_for_stations), np.array(true_ghis_for_station), np.array(
-        clearSky_ghis_for_station), np.array(station_ids), np.array(considered_timestamps), np.array(
-        night_time_flags_for_station)
+def remove_stale_slice_files(save_dir_path, slice_name, new_file_names):
+    """
+    Forgets the previous run of a slice before its new files are published: its manifest is removed and the
+    files it listed that the new run does not overwrite are deleted, so that the data loader never reads them
+    """
+    manifest = load_slice_manifest(save_dir_path, slice_name)
+    if manifest is None:
+        return
+    os.remove(os.path.join(save_dir_path, MANIFEST_DIR_NAME, slice_name + ".json"))
+    for f in manifest["files"]:
+        if f["name"] not in new_file_names:
+            try:
+                os.remove(os.path.join(save_dir_path, f["name"]))
+            except FileNotFoundError:
+                pass
+
+
+def save_slice_manifest(save_dir_path, slice_name, fingerprint, files):
+    """
+    Records a completed slice, with the name, sample count, size and checksum of every file it produced
+    """
+    manifest_dir = os.path.join(save_dir_path, MANIFEST_DIR_NAME)
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest = {
+        "slice": slice_name,
+        "fingerprint": fingerprint,
+        "samples": sum(f["samples"] for f in files),
+        "files": files,
+        "completed_at": datetime.datetime.now().isoformat(),
+    }
+    manifest_path = os.path.join(manifest_dir, slice_name + ".json")
+    with open(manifest_path + ".tmp", "w") as fd:
+        json.dump(manifest, fd, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def load_manifest(save_dir_path):
+    """
+    :return: list of the manifests of all the completed slices of an output folder
+    """
+    manifests = []
+    for manifest_path in sorted(glob.glob(os.path.join(save_dir_path, MANIFEST_DIR_NAME, "slice_*.json"))):
+        with open(manifest_path, "r") as fd:
+            manifests.append(json.load(fd))
+    return manifests
 
 
 def save_batches(main_df, dataframe, stations_coordinates, user_config, train_config, save_dir_path, start_index,
                  end_index, mini_batch_size, is_eval=False):
     """ 
     Helper function for create_and_save_batches function
+    :return: number of samples saved for this slice (0 if it was already completed)
     """
     input_time_offsets = [pd.Timedelta(d).to_pytimedelta() for d in user_config["input_time_offsets"]]
     target_time_offsets = [pd.Timedelta(d).to_pytimedelta() for d in train_config["target_time_offsets"]]
@@ -405,19 +771,57 @@ def save_batches(main_df, dataframe, stations_coordinates, user_config, train_co
 
     window_size = user_config["image_size_m"] // 2
 
-    concat_images = np.array([])
-    target_trueGHIs = np.array([])
-    target_clearSkyGHIs = np.array([])
-    target_timestamps = np.array([])
-    target_station_ids = np.array([])
-    target_night_time_flags = np.array([])
-    index = 0
-    batch_counter = start_index
+    if "hdf5_reader_pool_size" in user_config:
+        utils.HDF5_READER_POOL_SIZE = user_config["hdf5_reader_pool_size"]
+
+    storage_config = get_batch_storage_config(user_config, train_config)
 
     if not os.path.exists(save_dir_path):
         os.makedirs(save_dir_path)
 
-    for time_index, _ in tqdm.tqdm(main_df[start_index:end_index].iterrows()):
+    # skip the slice if a previous run already completed it
+    slice_df = main_df[start_index:end_index]
+    slice_name = get_slice_name(start_index, end_index)
+    fingerprint = get_slice_fingerprint(slice_df, stations_coordinates, user_config, train_config, storage_config)
+    if is_slice_complete(save_dir_path, slice_name, fingerprint):
+        print("Slice {} already completed, skipping it".format(slice_name))
+        return 0
+
+    # files are written in a temporary folder and only moved to save_dir_path once the whole slice is done. Each
+    # run has its own folder, so that concurrent runs of the same slice do not overwrite each other's files (those
+    # left by interrupted runs are never read)
+    tmp_dir_path = tempfile.mkdtemp(prefix="_tmp_" + slice_name + "_", dir=save_dir_path)
+    saved_files = []
+    batch_counter = start_index
+
+    if storage_config["layout"] == "sharded":
+        shard_name = SHARD_FILE_PREFIX + str(start_index).zfill(7) + ".hdf5"
+        shard_writer = ShardWriter(os.path.join(tmp_dir_path, shard_name), storage_config)
+        saved_files.append({"name": shard_name, "samples": 0})
+
+    def save_batch(images, trueGHIs, clearSkyGHIs, station_ids, timestamps, night_time_flags):
+        nonlocal batch_counter
+        if storage_config["layout"] == "sharded":
+            shard_writer.append(images, trueGHIs, clearSkyGHIs, station_ids, timestamps, night_time_flags)
+            saved_files[0]["samples"] += len(images)
+            return
+        batch_counter += 1
+        file_name = "batch_val_" + str(batch_counter).zfill(4)
+        save_image_and_batch(tmp_dir_path, file_name, images, trueGHIs, clearSkyGHIs, station_ids, timestamps,
+                             night_time_flags, storage_config)
+        saved_files.append({"name": file_name + ".hdf5", "samples": len(images)})
+
+    batch_buffer = BatchBuffer(mini_batch_size, save_batch)
+
+    frame_cache = get_frame_cache(user_config)
+    channel_means = np.array(storage_config["channel_means"], dtype=np.float32)
+    channel_stds = np.array(storage_config["channel_stds"], dtype=np.float32)
+
+    # precompute all the targets of this slice at once instead of querying the dataframe for every sample
+    label_table = build_label_table(dataframe, slice_df.index, list(stations_coordinates.keys()),
+                                    target_time_offsets, is_eval)
+
+    for label_idx, (time_index, _) in enumerate(tqdm.tqdm(slice_df.iterrows())):
         # get past timestamps in range of input_seq_length
         timestamps_from_history = []
         for i in range(user_config["input_seq_length"]):
@@ -425,13 +829,17 @@ def save_batches(main_df, dataframe, stations_coordinates, user_config, train_co
 
         images, trueGHIs, clearSkyGHIs, station_ids, timestamps, night_time_flags = \
             crop_images(main_df,
-                        dataframe,
+                        label_table,
+                        label_idx,
                         timestamps_from_history,
-                        target_time_offsets,
                         stations_coordinates,
                         window_size,
                         time_zone_mapping,
-                        is_eval)
+                        is_eval,
+                        frame_cache,
+                        channel_means,
+                        channel_stds,
+                        user_config.get("frame_window_reads", True))
 
         if images is None:
             # print("No image found for timestamp {}".format(time_index))
@@ -441,52 +849,123 @@ def save_batches(main_df, dataframe, stations_coordinates, user_config, train_co
         if trueGHIs is None:
             continue
 
-        if len(concat_images) == 0:
-            concat_images = images
-            target_trueGHIs = trueGHIs
-            target_clearSkyGHIs = clearSkyGHIs
-            target_timestamps = timestamps
-            target_station_ids = station_ids
-            target_night_time_flags = night_time_flags
+        # samples past mini_batch_size are carried over to the next batch file
+        batch_buffer.append(images, trueGHIs, clearSkyGHIs, station_ids, timestamps, night_time_flags)
+
+    # save the remaining samples of this slice in a smaller batch file
+    batch_buffer.flush()
+
+    # publish the files of the slice, then record it as completed
+    saved_files = [f for f in saved_files if f["samples"] > 0]
+    remove_stale_slice_files(save_dir_path, slice_name, {f["name"] for f in saved_files})
+    for saved_file in saved_files:
+        tmp_path = os.path.join(tmp_dir_path, saved_file["name"])
+        saved_file["bytes"] = os.path.getsize(tmp_path)
+        saved_file["md5"] = get_file_md5(tmp_path)
+        os.replace(tmp_path, os.path.join(save_dir_path, saved_file["name"]))
+    shutil.rmtree(tmp_dir_path, ignore_errors=True)
+    save_slice_manifest(save_dir_path, slice_name, fingerprint, saved_files)
+
+    cache_stats = frame_cache.stats()
+    print("Frame cache (pid {}): {} hits, {} misses ({:.1%} hit rate), {} frames, {:.0f}/{:.0f} MB".format(
+        os.getpid(), cache_stats["hits"], cache_stats["misses"], cache_stats["hit_rate"], cache_stats["frames"],
+        cache_stats["nbytes"] / 1024 ** 2, cache_stats["max_bytes"] / 1024 ** 2))
+    return sum(f["samples"] for f in saved_files)
+
+
+def get_slices(main_df, slice_size, group_by_file=False):
+    """
+    :return: list of (start_index, end_index) row ranges of the tasks of batch creation. If group_by_file is
+    set, slices are made of whole source HDF5 files (main_df being ordered by file) so that each worker reads
+    its own daily files sequentially
+    """
+    if not group_by_file:
+        return [(i, i + slice_size) for i in range(0, len(main_df), slice_size)]
+
+    hdf5_paths = main_df["hdf5_8bit_path"].to_numpy()
+    file_starts = np.flatnonzero(np.r_[True, hdf5_paths[1:] != hdf5_paths[:-1]]).tolist() + [len(main_df)]
+    slices = []
+    start = 0
+    for file_start in file_starts[1:]:
+        if file_start - start >= slice_size or file_start == len(main_df):
+            slices.append((start, file_start))
+            start = file_start
+    return slices
+
+
+def get_pool_config(user_config):
+    """
+    :return: worker pool parameters of batch creation, taken from the user config
+    """
+    return {
+        "workers": user_config.get("batch_workers", 4),
+        # number of T0s processed by a save_batches call
+        "slice_size": user_config.get("batch_slice_size", 500),
+        # "static": slices are split evenly between workers beforehand (starmap);
+        # "dynamic": idle workers pull the next slices as they go (imap_unordered)
+        "scheduling": user_config.get("batch_scheduling", "dynamic"),
+        # number of slices pulled at once by a worker in dynamic scheduling
+        "chunksize": user_config.get("batch_chunksize", 1),
+        # "shuffled": T0s are shuffled before creating the batches;
+        # "by_file": T0s are processed grouped by source HDF5 file and shuffled afterwards (sharded layout only)
+        "order": user_config.get("batch_generation_order", "shuffled"),
+    }
+
+
+# dataframes shared by all the tasks of a worker, set once by the pool initializer instead of pickling them
+# with every task
+_worker_data = {}
+
+
+def init_batch_worker(main_df, dataframe):
+    global _worker_data
+    _worker_data = {"main_df": main_df, "dataframe": dataframe}
+
+
+def save_batches_task(args):
+    """
+    Runs save_batches on the shared dataframes of the worker
+    :return: dictionnary of the worker pid, number of saved samples and elapsed time
+    """
+    start_time = time.time()
+    nb_samples = save_batches(_worker_data["main_df"], _worker_data["dataframe"], *args)
+    return {"pid": os.getpid(), "samples": nb_samples, "seconds": time.time() - start_time}
+
+
+def run_save_batches(main_df, dataframe, args_array, pool_config):
+    """
+    Runs save_batches for all the given arguments (without the dataframes) on a pool of workers,
+    and reports the throughput of each worker
+    """
+    start_time = time.time()
+    with multiprocessing.Pool(pool_config["workers"], initializer=init_batch_worker,
+                              initargs=(main_df, dataframe)) as p:
+        if pool_config["scheduling"] == "static":
+            results = p.map(save_batches_task, args_array)
         else:
-            concat_images = np.append(concat_images, images, axis=0)
-            target_trueGHIs = np.append(target_trueGHIs, trueGHIs, axis=0)
-            target_clearSkyGHIs = np.append(target_clearSkyGHIs, clearSkyGHIs, axis=0)
-            target_timestamps = np.append(target_timestamps, timestamps, axis=0)
-            target_station_ids = np.append(target_station_ids, station_ids, axis=0)
-            target_night_time_flags = np.append(target_night_time_flags, night_time_flags, axis=0)
-
-        index += images.shape[0]
-
-        # save h5py file here
-        if index >= mini_batch_size:
-            assert concat_images.shape[0] == target_trueGHIs.shape[0]
-            assert concat_images.shape[0] == target_clearSkyGHIs.shape[0]
-            assert concat_images.shape[0] == target_timestamps.shape[0]
-            assert concat_images.shape[0] == target_station_ids.shape[0]
-            assert concat_images.shape[0] == target_night_time_flags.shape[0]
-
-            batch_counter += 1
-            file_name = "batch_val_" + str(batch_counter).zfill(4)
-
-            save_image_and_batch(save_dir_path, file_name,
-                                 concat_images[:mini_batch_size],
-                                 target_trueGHIs[:mini_batch_size],
-                                 target_clearSkyGHIs[:mini_batch_size],
-                                 target_station_ids[:mini_batch_size],
-                                 target_timestamps[:mini_batch_size],
-                                 target_night_time_flags[:mini_batch_size])
-            # print(target_timestamps)
-            # break
-
-            concat_images = np.array([])
-            target_trueGHIs = np.array([])
-            target_clearSkyGHIs = np.array([])
-            target_station_ids = np.array([])
-            target_timestamps = np.array([])
-            target_night_time_flags = np.array([])
-
-            index = 0
+            assert pool_config["scheduling"] == "dynamic", f"unknown scheduling {pool_config['scheduling']}"
+            results = list(tqdm.tqdm(p.imap_unordered(save_batches_task, args_array, pool_config["chunksize"]),
+                                     total=len(args_array), desc="slices"))
+        # the workers exit normally instead of being terminated when leaving the with block, so that their
+        # finalizers close the HDF5 readers they kept open across slices
+        p.close()
+        p.join()
+    elapsed = time.time() - start_time
+
+    workers_stats = collections.defaultdict(lambda: {"slices": 0, "samples": 0, "seconds": 0.0})
+    for result in results:
+        worker_stats = workers_stats[result["pid"]]
+        worker_stats["slices"] += 1
+        worker_stats["samples"] += result["samples"]
+        worker_stats["seconds"] += result["seconds"]
+    for pid, worker_stats in sorted(workers_stats.items()):
+        print("Worker {}: {} slices, {} samples in {:.0f}s ({:.2f} samples/s)".format(
+            pid, worker_stats["slices"], worker_stats["samples"], worker_stats["seconds"],
+            worker_stats["samples"] / max(worker_stats["seconds"], 1e-9)))
+    nb_samples = sum(result["samples"] for result in results)
+    print("Total: {} samples in {:.0f}s ({:.2f} samples/s) with {} workers".format(
+        nb_samples, elapsed, nb_samples / max(elapsed, 1e-9), pool_config["workers"]))
+    return results
 
 
 def fill_zero_for_night_ghi_nans(df, column_name, stations):
@@ -544,10 +1023,12 @@ def handle_ghi_nans(old_df, handle_true_ghi=True, handle_clearsky_ghis=True):
 def create_and_save_batches(
         admin_config_path: typing.AnyStr,
         user_config_path: typing.Optional[typing.AnyStr] = None,
-        is_eval=False
+        is_eval=False,
+        pool_config_overrides: typing.Optional[typing.Dict[str, typing.Any]] = None
 ) -> None:
     """ 
     This function create and save batches of images and other features used for training in .h5 file
+    pool_config_overrides: worker pool parameters (see get_pool_config) overriding the user config ones
     """
     user_config = {}
     if user_config_path:
@@ -555,6 +1036,9 @@ def create_and_save_batches(
         with open(user_config_path, "r") as fd:
             user_config = json.load(fd)
 
+    pool_config = get_pool_config(user_config)
+    pool_config.update({k: v for k, v in (pool_config_overrides or {}).items() if v is not None})
+
     assert os.path.isfile(admin_config_path), f"invalid admin config file: {admin_config_path}"
     with open(admin_config_path, "r") as fd:
         admin_config = json.load(fd)
@@ -592,14 +1076,16 @@ def create_and_save_batches(
             val_file_path = os.path.join(user_config['val_data_folder'], str(station))
             mini_batch_size = 1
             args = (
-                filtered_dataframe_, dataframe, {station: stations_coordinates[station]}, user_config,
+                {station: stations_coordinates[station]}, user_config,
                 admin_config, val_file_path, 0,
                 len(filtered_dataframe_) + 1, mini_batch_size, is_eval)
             args_array.append(args)
 
-        p = multiprocessing.Pool(4)
         print("Saving batches now...")
-        p.starmap(save_batches, args_array)
+        run_save_batches(filtered_dataframe_, dataframe, args_array, pool_config)
+        if get_batch_storage_config(user_config, admin_config)["layout"] == "sharded":
+            for station, _ in stations.items():
+                build_shard_index(os.path.join(user_config['val_data_folder'], str(station)))
         print("Done")
 
         # for station, _ in stations.items():
@@ -619,31 +1105,38 @@ def create_and_save_batches(
         train_dataframe = dataframe.loc['2010-01-01':'2015-01-01']
         val_dataframe = dataframe.loc['2015-01-01':'2015-12-31']
 
-        train_dataframe = preprocess_dataframe(train_dataframe, stations)
-        val_dataframe = preprocess_dataframe(val_dataframe, stations)
+        random_seed = user_config.get("random_seed", 0)
+        group_by_file = pool_config["order"] == "by_file"
+        if group_by_file:
+            assert get_batch_storage_config(user_config, admin_config)["layout"] == "sharded", \
+                "batches created by file must be shuffled afterwards, which requires the sharded layout"
+        train_dataframe = preprocess_dataframe(train_dataframe, stations, random_seed, group_by_file)
+        val_dataframe = preprocess_dataframe(val_dataframe, stations, random_seed, group_by_file)
 
         my_train_args = []
         mini_batch_size = user_config['mini_batch_size']
-        step_size = 500
+        step_size = pool_config["slice_size"]
         train_file_path = "/project/cq-training-1/project1/teams/team08/data/train_crops_seq_3_harman"
         # renaming it to save in the same folder as train
         val_file_path = "/project/cq-training-1/project1/teams/team08/data/train_crops_seq_3_harman"
 
-        for i in range(0, len(train_dataframe) + 1000, step_size):
-            args = (
-                train_dataframe, dataframe, stations_coordinates, user_config, admin_config, train_file_path, int(i),
-                int(i) + step_size, mini_batch_size)
+        for start, end in get_slices(train_dataframe, step_size, group_by_file):
+            args = (stations_coordinates, user_config, admin_config, train_file_path, int(start),
+                    int(end), mini_batch_size)
             my_train_args.append(args)
 
         my_val_args = []
-        for i in range(0, len(val_dataframe) + 1000, step_size):
-            args = (val_dataframe, dataframe, stations_coordinates, user_config, admin_config, val_file_path, int(i),
-                    int(i) + step_size, mini_batch_size)
+        for start, end in get_slices(val_dataframe, step_size, group_by_file):
+            args = (stations_coordinates, user_config, admin_config, val_file_path, int(start),
+                    int(end), mini_batch_size)
             my_val_args.append(args)
 
-        p = multiprocessing.Pool(4)
-        print("Saving batches now...")
-        p.starmap(save_batches, my_val_args)
+        print("Saving batches now... ({} slices already completed)".format(len(load_manifest(val_file_path))))
+        run_save_batches(val_dataframe, dataframe, my_val_args, pool_config)
+        if get_batch_storage_config(user_config, admin_config)["layout"] == "sharded":
+            build_shard_index(val_file_path)
+            if group_by_file:
+                shuffle_shard_index(val_file_path, random_seed)
         print("Done")
 
 
@@ -656,11 +1149,21 @@ if __name__ == "__main__":
     parser.add_argument("-u", "--user_cfg_path", type=str,
                         help="path to the JSON config file used to store user model/dataloader parameters",
                         default="eval_user_cfg_lstm.json")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="number of worker processes (overrides batch_workers of the user config)")
+    parser.add_argument("--slice_size", type=int,
+                        help="number of T0s per task (overrides batch_slice_size of the user config)")
+    parser.add_argument("--scheduling", type=str, choices=["static", "dynamic"],
+                        help="assignment of tasks to workers (overrides batch_scheduling of the user config)")
+    parser.add_argument("--order", type=str, choices=["shuffled", "by_file"],
+                        help="order in which T0s are processed (overrides batch_generation_order of the user config)")
 
     args = parser.parse_args()
 
     create_and_save_batches(
         admin_config_path=args.admin_cfg_path,
         user_config_path=args.user_cfg_path,
-        is_eval=False
+        is_eval=False,
+        pool_config_overrides={"workers": args.workers, "slice_size": args.slice_size, "scheduling": args.scheduling,
+                               "order": args.order}
     )
@@ -4,10 +4,212 @@ import datetime
 import pandas as pd
 import numpy as np
 import tensorflow as tf
-from sklearn.preprocessing import OneHotEncoder
 from numpy.core._multiarray_umath import ndarray
 from model_logging import get_logger
+import utils
 import glob
+import os
+import collections
+import contextlib
+import itertools
+import multiprocessing
+import hashlib
+import json
+import logging
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    # registers the lz4/blosc HDF5 filters that compact batch files may be compressed with
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    pass
+
+# index of a sharded dataset, written by create_batch_files.build_shard_index
+SHARD_INDEX_FILE_NAME = "index.hdf5"
+
+# inputs of the models, in the order in which they are yielded; models declare the ones they use in REQUIRED_INPUTS
+INPUT_NAMES = ("images", "clearsky_GHI", "true_GHI", "night_flags", "station_id_onehot", "date_vector")
+
+# state of a reader process, set by _init_reader_worker
+_worker_loader = None
+_worker_shard_readers = {}
+
+
+def _init_reader_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+
+
+def _process_batch_in_worker(unit, inputs):
+    return _worker_loader.process_batch(unit, _worker_shard_readers, inputs)
+
+
+class MemoryBatchCache():
+    """
+    Keeps the decoded batches of a full pass over the dataset in RAM, to serve the following epochs
+    """
+
+    def __init__(self):
+        self.batches = None
+
+    def is_complete(self):
+        return self.batches is not None
+
+    def read_batches(self):
+        yield from self.batches
+
+    def write_batches(self, batches):
+        """Yields the given batches, keeping them once all of them were consumed (a partial pass is dropped)."""
+        collected = []
+        for batch in batches:
+            collected.append(batch)
+            yield batch
+        self.batches = collected
+
+
+class MemmapBatchCache():
+    """
+    Flat on-disk store of the decoded batches of a full pass over the dataset: one raw file per array of the
+    batch tuple plus a JSON index of their dtypes, sample shapes and batch offsets. Following epochs are served
+    through ``np.memmap`` without decoding anything
+    """
+
+    INDEX_FILE_NAME = "index.json"
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+
+    def is_complete(self):
+        return os.path.isfile(os.path.join(self.dir_path, self.INDEX_FILE_NAME))
+
+    def read_batches(self):
+        with open(os.path.join(self.dir_path, self.INDEX_FILE_NAME), "r") as fd:
+            index = json.load(fd)
+        offsets = index["batch_offsets"]
+        arrays = [np.memmap(os.path.join(self.dir_path, f"array_{i}.bin"), dtype=a["dtype"], mode='r',
+                            shape=(offsets[-1],) + tuple(a["sample_shape"]))
+                  for i, a in enumerate(index["arrays"])]
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield tuple(array[start:end] for array in arrays)
+
+    def write_batches(self, batches):
+        """Yields the given batches while exporting them; the store is only published once all were consumed."""
+        tmp_dir_path = self.dir_path + ".tmp"
+        shutil.rmtree(tmp_dir_path, ignore_errors=True)
+        os.makedirs(tmp_dir_path)
+        files, arrays, offsets = [], None, [0]
+        try:
+            for batch in batches:
+                if arrays is None:
+                    arrays = [{"dtype": a.dtype.str, "sample_shape": list(a.shape[1:])} for a in batch]
+                    files = [open(os.path.join(tmp_dir_path, f"array_{i}.bin"), 'wb') for i in range(len(batch))]
+                for fd, array in zip(files, batch):
+                    fd.write(np.ascontiguousarray(array).tobytes())
+                offsets.append(offsets[-1] + len(batch[0]))
+                yield batch
+            for fd in files:
+                fd.close()
+            with open(os.path.join(tmp_dir_path, self.INDEX_FILE_NAME), 'w') as fd:
+                json.dump({"arrays": arrays or [], "batch_offsets": offsets}, fd)
+            os.replace(tmp_dir_path, self.dir_path)
+        finally:
+            for fd in files:
+                fd.close()
+            shutil.rmtree(tmp_dir_path, ignore_errors=True)
+
+
+class FileStager():
+    """
+    Copies files to a local staging directory in a background thread, in the order in which they will be read.
+    Files are renamed into place once fully copied, so a staged path is always complete; files that are not
+    staged yet, that do not fit in the disk budget, or whose copy is outdated are read from their remote path
+    """
+
+    def __init__(self, remote_paths, staging_dir, max_bytes=None, logger=None):
+        self.remote_paths = list(remote_paths)
+        self.staging_dir = staging_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.stop_event = threading.Event()
+        os.makedirs(self.staging_dir, exist_ok=True)
+        # partial copies of an interrupted run
+        for tmp_path in glob.glob(os.path.join(self.staging_dir, "*.tmp")):
+            os.remove(tmp_path)
+        self.thread = threading.Thread(target=self.stage_files, name="FileStager", daemon=True)
+        self.thread.start()
+
+    def __getstate__(self):
+        # the reader processes only resolve paths; the staging thread stays in the process that created the stager
+        state = dict(self.__dict__)
+        state["stop_event"] = None
+        state["thread"] = None
+        return state
+
+    def get_local_path(self, remote_path):
+        return os.path.join(self.staging_dir, os.path.basename(remote_path))
+
+    def is_staged(self, remote_path, remote_stat=None):
+        """A staged copy matches the size and modification time of its remote file (like rsync's quick check)."""
+        local_path = self.get_local_path(remote_path)
+        if not os.path.isfile(local_path):
+            return False
+        remote_stat = remote_stat or os.stat(remote_path)
+        local_stat = os.stat(local_path)
+        return local_stat.st_size == remote_stat.st_size and int(local_stat.st_mtime) == int(remote_stat.st_mtime)
+
+    def resolve(self, remote_path):
+        """
+        Returns the path to read a file from: its staged copy if it matches the remote file, the remote path
+        otherwise. Copies only appear under their final name when done, but one left by an earlier run may be
+        outdated until the staging thread replaces it
+        """
+        return self.get_local_path(remote_path) if self.is_staged(remote_path) else remote_path
+
+    def stage_files(self):
+        try:
+            self.copy_files()
+        except OSError as e:
+            # the files that are not staged yet are read remotely
+            self.log(f"Staging stopped: {e}", level=logging.WARNING)
+
+    def copy_files(self):
+        staged_bytes = 0
+        for remote_path in self.remote_paths:
+            if self.stop_event.is_set():
+                return
+            remote_stat = os.stat(remote_path)
+            if self.max_bytes is not None and staged_bytes + remote_stat.st_size > self.max_bytes:
+                self.log(f"Staging budget reached, {remote_path} and the next files are read remotely")
+                return
+            staged_bytes += remote_stat.st_size
+            if self.is_staged(remote_path, remote_stat):
+                continue
+            if shutil.disk_usage(self.staging_dir).free < remote_stat.st_size:
+                self.log(f"Staging disk full, {remote_path} and the next files are read remotely")
+                return
+            local_path = self.get_local_path(remote_path)
+            if os.path.exists(local_path):
+                # stale copy of a file that changed remotely
+                os.remove(local_path)
+            tmp_path = local_path + ".tmp"
+            try:
+                shutil.copy2(remote_path, tmp_path)
+                os.replace(tmp_path, local_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def log(self, message, level=logging.DEBUG):
+        if self.logger is not None:
+            self.logger.log(level, message)
 
 
 class DataLoader():
@@ -19,7 +221,8 @@ class DataLoader():
             stations: typing.Dict[typing.AnyStr, typing.Tuple[float, float, float]],
             target_time_offsets: typing.List[datetime.timedelta],
             config: typing.Dict[typing.AnyStr, typing.Any],
-            data_folder: typing.AnyStr
+            data_folder: typing.AnyStr,
+            required_inputs: typing.Optional[typing.Iterable[typing.AnyStr]] = None
     ):
         """
         Copy-paste from evaluator.py:
@@ -33,6 +236,9 @@ class DataLoader():
             stations: a map of station names of interest paired with their coordinates (latitude, longitude, elevation)
             target_time_offsets: the list of time-deltas to predict GHIs for (by definition: [T=0, T+1h, T+3h, T+6h]).
             config: configuration dictionary holding extra parameters
+            data_folder: folder of the batch files
+            required_inputs: names (from ``INPUT_NAMES``) of the inputs the model uses, usually its
+                ``REQUIRED_INPUTS``; the others are not read and are yielded as zeros. All inputs are read by default.
         """
         self.dataframe = dataframe
         self.target_datetimes = target_datetimes
@@ -40,6 +246,9 @@ class DataLoader():
         self.config = config
         self.target_time_offsets = target_time_offsets
         self.data_folder = data_folder
+        # the true GHIs are always read since they are also the targets
+        self.required_inputs = set(INPUT_NAMES if required_inputs is None else required_inputs) | {"true_GHI"}
+        self.skipped_inputs = set()
         self.initialize()
 
     def initialize(self):
@@ -47,60 +256,405 @@ class DataLoader():
         self.logger.debug("Initialize start")
         self.test_station = self.stations[0]
         self.output_seq_len = len(self.target_time_offsets)
-        self.data_files_list = glob.glob(self.data_folder + "/*.hdf5")
-        # sort required for evaluator script
-        self.data_files_list.sort()
+        self.shard_index = None
+        shard_index_path = os.path.join(self.data_folder, SHARD_INDEX_FILE_NAME)
+        if os.path.isfile(shard_index_path):
+            # sharded dataset: samples are read by random access through the index
+            self.shard_index = self.load_shard_index(shard_index_path)
+            self.data_files_list = self.shard_index["shard_files"]
+            self.shard_batch_size = self.config.get("mini_batch_size", 256)
+            self.nb_batches = int(np.ceil(len(self.shard_index["shard"]) / self.shard_batch_size))
+        else:
+            self.data_files_list = glob.glob(self.data_folder + "/*.hdf5")
+            # sort required for evaluator script
+            self.data_files_list.sort()
+            self.nb_batches = len(self.data_files_list)
+
+        # one-hot rows of the stations, indexed by station code. By default the stations are sorted by name, like
+        # the categories of the former OneHotEncoder; "onehot_stations" pins the encoding of a trained model when the
+        # stations map holds only some of its stations (e.g. in the evaluator)
+        onehot_stations = self.config.get("onehot_stations", sorted(self.stations))
+        missing_stations = [name for name in self.stations if name not in onehot_stations]
+        assert not missing_stations, \
+            f"stations {missing_stations} have no one-hot encoding, set \"onehot_stations\" in the user config"
+        self.station_codes = {name.encode("ascii"): code for code, name in enumerate(onehot_stations)}
+        self.station_onehots = np.eye(len(onehot_stations), dtype=np.float32)
+
+        # reader processes: 0 or 1 reads in the training process; the evaluator needs the deterministic order
+        self.num_parallel_reads = self.config.get("data_loader_workers", 0)
+        self.reader_queue_size = self.config.get("data_loader_queue_size", 2 * max(self.num_parallel_reads, 1))
+        self.deterministic_reads = self.config.get("data_loader_deterministic", True)
+        self.reader_pool = None
+
+        # time spent per read stage, only collected by benchmark_data_loader.py since it is not shared by the
+        # reader processes
+        self.stage_times = None
 
-        stations = np.array([b"BND", b"TBL", b"DRA", b"FPK", b"GWN", b"PSU", b"SXF"])
-        self.encoder = OneHotEncoder(sparse=False)
-        stations = stations.reshape(len(stations), 1)
-        self.encoder.fit(stations)
+        self.batch_cache = self.get_batch_cache()
+        self.file_stager = self.get_file_stager()
+        if self.num_parallel_reads > 1:
+            self.reader_pool = self.create_reader_pool()
 
         self.data_loader = tf.data.Dataset.from_generator(
             self.data_generator_fn,
             output_types=(tf.float32, tf.float32, tf.float32, tf.bool, tf.float32, tf.float32, tf.float32)
-        ).prefetch(tf.data.experimental.AUTOTUNE)
-
-    def to_cyclical_secondofday(self, date):
-        SECONDS_PER_DAY = 24 * 60 * 60
-        second_of_day = (date.hour * 60 + date.minute) * 60 + date.second
-        day_cycle_rad = second_of_day / SECONDS_PER_DAY * 2.0 * np.pi
-        day_cycle_x = np.sin(day_cycle_rad)
-        day_cycle_y = np.cos(day_cycle_rad)
-        return pd.DataFrame(day_cycle_x), pd.DataFrame(day_cycle_y)
-
-    def to_cyclical_dayofyear(self, date):
-        DAYS_PER_YEAR = 365
-        year_cycle_rad = date.dayofyear / DAYS_PER_YEAR
-        year_cycle_x = np.sin(year_cycle_rad)
-        year_cycle_y = np.cos(year_cycle_rad)
-        return pd.DataFrame(year_cycle_x), pd.DataFrame(year_cycle_y)
+        )
+        if self.config.get("data_loader_rebatch", False):
+            self.data_loader = self.rebatch(self.data_loader)
+        self.data_loader = self.data_loader.prefetch(tf.data.experimental.AUTOTUNE)
 
-    def create_sin_cos(self, date):
-        date = date.astype('U50')
-        date = pd.to_datetime(date.flatten())
-        day_cycle_x, day_cycle_y = self.to_cyclical_secondofday(date)
-        year_cycle_x, year_cycle_y = self.to_cyclical_dayofyear(date)
-        return np.array(pd.concat((day_cycle_x, day_cycle_y, year_cycle_x, year_cycle_y), axis=1))
+    def rebatch(self, dataset):
+        """
+        Splits the batches read from the files into samples, shuffles them across files with a buffer of
+        "shuffle_buffer_size" samples (reshuffled at every epoch, 0 to keep the file order) and regroups them into
+        batches of "batch_size" samples, so that neither depends on how the batch files were generated.
+        """
+        batch_size = self.config["batch_size"]
+        shuffle_buffer_size = self.config.get("shuffle_buffer_size", 0)
+        self.nb_batches = int(np.ceil(self.count_samples() / batch_size))
 
-    def get_onehot_station_id(self, station_ids):
-        return self.encoder.transform(station_ids)
+        dataset = dataset.unbatch()
+        if shuffle_buffer_size > 0:
+            dataset = dataset.shuffle(shuffle_buffer_size, seed=self.config.get("random_seed"),
+                                      reshuffle_each_iteration=True)
+        return dataset.batch(batch_size)
 
-    def data_generator_fn(self):
+    def count_samples(self):
+        """Counts the samples of the dataset, from the index of a sharded dataset or the shapes of the batch files."""
+        if self.shard_index is not None:
+            return len(self.shard_index["shard"])
+        nb_samples = 0
         for f_path in self.data_files_list:
-            # f_path = os.path.join(self.data_folder, file)
-
             with h5py.File(f_path, 'r') as h5_data:
-                images = np.array(h5_data["images"])
-                true_GHIs: ndarray = np.array(h5_data["GHI"])
-                clearsky_GHIs = np.array(h5_data["clearsky_GHI"])
-                station_ids = np.array(h5_data["station_id"])
-                night_flags = np.array(h5_data["night_flags"]).astype(np.bool)
+                nb_samples += h5_data["GHI"].shape[0]
+        return nb_samples
+
+    def time_stage(self, stage):
+        """Returns a context manager adding its duration to ``stage_times[stage]`` when timings are collected."""
+        if self.stage_times is None:
+            return contextlib.nullcontext()
+        return self.timed_stage(stage)
+
+    @contextlib.contextmanager
+    def timed_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[stage] += time.perf_counter() - start
+
+    def create_sin_cos(self, date):
+        """Computes the (batch, 4) time features of epoch seconds, or of the datetime strings of legacy files."""
+        if not np.issubdtype(date.dtype, np.integer):
+            date = np.array(date.astype('U50').ravel(), dtype='datetime64[s]').astype(np.int64)
+        return utils.get_time_features(date)
+
+    def read_time_features(self, h5_data, selection):
+        """Reads the time features stored at batch creation, or computes them for files written without them."""
+        if "time_features" in h5_data:
+            return h5_data["time_features"][selection]
+        return self.create_sin_cos(h5_data["datetime_sequence"][selection])
+
+    def get_onehot_station_id(self, station_codes):
+        return self.station_onehots[station_codes]
+
+    def load_shard_index(self, index_path):
+        """Loads the index of a sharded dataset, mapping every sample to its shard, row, datetime and station."""
+        with h5py.File(index_path, 'r') as f:
+            return {
+                "shard_files": [os.path.join(self.data_folder, n.decode("ascii")) for n in f.attrs["shard_files"]],
+                "shard": f["shard"][()],
+                "row": f["row"][()],
+                "datetime_sequence": f["datetime_sequence"][()],
+                "station_id": f["station_id"][()],
+            }
+
+    def read_images(self, h5_data, selection):
+        """Reads the images of a batch file as float32, restoring them if they were stored as uint8/float16."""
+        images_dataset = h5_data["images"]
+        images = images_dataset[selection]
+        if "quantization_scale" in images_dataset.attrs:
+            images = images * images_dataset.attrs["quantization_scale"] + images_dataset.attrs["quantization_offset"]
+        elif "images_quantization_scale" in h5_data:
+            # shards store the quantization parameters of every sample
+            broadcast_shape = (len(images),) + (1,) * (images.ndim - 2) + (images.shape[-1],)
+            scale = h5_data["images_quantization_scale"][selection].reshape(broadcast_shape)
+            offset = h5_data["images_quantization_offset"][selection].reshape(broadcast_shape)
+            images = images * scale + offset
+        return images.astype(np.float32, copy=False)
+
+    def read_station_ids(self, h5_data, selection):
+        """Reads the station IDs of a batch file as a (batch,) array of station codes for ``get_onehot_station_id``."""
+        station_ids = h5_data["station_id"][selection]
+        if "station_names" in h5_data.attrs:
+            # compact layout: indices in the station names list of the file
+            file_codes = np.array([self.station_codes[n] for n in h5_data.attrs["station_names"]])
+            return file_codes[station_ids]
+        return np.array([self.station_codes[n] for n in station_ids.ravel()])
+
+    def read_batch(self, h5_data, rows=None, inputs=INPUT_NAMES):
+        """Reads all the samples of a batch file, or the given (sorted) rows of a shard, in any layout.
+
+        Only the datasets of the given inputs are read, the others being replaced by zeros (a single zero per
+        sample for the images).
+
+        Returns:
+            The images, true GHIs, clearsky GHIs, station IDs, night flags and time features of the samples.
+        """
+        if rows is None:
+            selection = slice(None)
+        elif rows[-1] - rows[0] + 1 == len(rows):
+            # contiguous rows are read as a single hyperslab
+            selection = slice(int(rows[0]), int(rows[-1]) + 1)
+        else:
+            selection = rows
+        with self.time_stage("dataset_read"):
+            true_GHIs: ndarray = h5_data["GHI"][selection]
+            batch_size, output_seq_len = true_GHIs.shape
+
+            if "images" in inputs:
+                images = self.read_images(h5_data, selection)
+            else:
+                # a zero-sized array would crash tf.data's unbatch
+                images = np.zeros((batch_size, 1), dtype=np.float32)
+            if "clearsky_GHI" in inputs:
+                clearsky_GHIs = h5_data["clearsky_GHI"][selection]
+            else:
+                clearsky_GHIs = np.zeros((batch_size, output_seq_len), dtype=np.float32)
+            if "night_flags" in inputs:
+                night_flags = h5_data["night_flags"][selection].astype(np.bool)
+            else:
+                night_flags = np.zeros((batch_size, output_seq_len), dtype=np.bool)
+        with self.time_stage("one_hot"):
+            station_ids = self.read_station_ids(h5_data, selection) if "station_id_onehot" in inputs else None
+        with self.time_stage("sin_cos"):
+            if "date_vector" in inputs:
+                date_vector = self.read_time_features(h5_data, selection)  # size: batch * 4
+            else:
+                date_vector = np.zeros((batch_size, 4), dtype=np.float32)
+        return images, true_GHIs, clearsky_GHIs, station_ids, night_flags, date_vector
+
+    def read_samples(self, shard_readers, sample_indices, inputs=INPUT_NAMES):
+        """Reads the given samples of a sharded dataset, in the given order.
+
+        Samples are grouped by shard and read in increasing row order. ``shard_readers`` maps shard indices to the
+        shard files that were already opened, and is updated with the ones opened by this call.
+        """
+        shards = self.shard_index["shard"][sample_indices]
+        rows = self.shard_index["row"][sample_indices]
+        order = np.lexsort((rows, shards))
+        shards, rows = shards[order], rows[order]
+
+        shard_batches = []
+        for shard in np.unique(shards):
+            shard_path = self.resolve_path(self.data_files_list[shard])
+            if shard in shard_readers and shard_readers[shard].filename != shard_path:
+                # the shard was staged since it was opened
+                shard_readers.pop(shard).close()
+            if shard not in shard_readers:
+                with self.time_stage("h5_open"):
+                    shard_readers[shard] = h5py.File(shard_path, 'r')
+            shard_batches.append(self.read_batch(shard_readers[shard], rows[shards == shard], inputs))
+
+        # restore the requested sample order
+        inverse_order = np.empty_like(order)
+        inverse_order[order] = np.arange(len(order))
+        return tuple(None if arrays[0] is None else np.concatenate(arrays)[inverse_order]
+                     for arrays in zip(*shard_batches))
+
+    def get_batch_units(self):
+        """Lists the units of work of an epoch: batch file paths, or arrays of ``mini_batch_size`` shard samples."""
+        if self.shard_index is None:
+            return list(self.data_files_list)
+        nb_samples = len(self.shard_index["shard"])
+        return [np.arange(start, min(start + self.shard_batch_size, nb_samples))
+                for start in range(0, nb_samples, self.shard_batch_size)]
+
+    def read_batch_unit(self, unit, shard_readers, inputs):
+        """Reads the raw arrays of one unit of work; ``shard_readers`` keeps shard files open across calls."""
+        if self.shard_index is None:
+            with self.time_stage("h5_open"):
+                h5_data = h5py.File(self.resolve_path(unit), 'r')
+            with h5_data:
+                return self.read_batch(h5_data, inputs=inputs)
+        return self.read_samples(shard_readers, unit, inputs)
+
+    def process_batch(self, unit, shard_readers, inputs):
+        """Reads one unit of work and turns it into the tuple of model inputs and targets."""
+        images, true_GHIs, clearsky_GHIs, station_ids, night_flags, date_vector = \
+            self.read_batch_unit(unit, shard_readers, inputs)
+        with self.time_stage("one_hot"):
+            if station_ids is None:
+                station_id_onehot = np.zeros((len(true_GHIs), len(self.station_onehots)), dtype=np.float32)
+            else:
                 station_id_onehot = self.get_onehot_station_id(station_ids)
-                date = np.array(h5_data['datetime_sequence'])
-                date_vector = self.create_sin_cos(date)  # size: batch * 4
 
-                yield images, clearsky_GHIs, true_GHIs, night_flags, station_id_onehot, date_vector, true_GHIs
+        return images, clearsky_GHIs, true_GHIs, night_flags, station_id_onehot, date_vector, true_GHIs
+
+    def __getstate__(self):
+        # state of the loader in the reader processes, which only read batches: the tf.data pipeline, the batch
+        # cache and the reader pool stay in this process
+        state = dict(self.__dict__)
+        for name in ("dataframe", "target_datetimes", "data_loader", "batch_cache", "reader_pool", "stage_times"):
+            state[name] = None
+        return state
+
+    def create_reader_pool(self):
+        """
+        Starts the reader processes. h5py serialises all the HDF5 calls of a process behind a global lock, so the
+        reads only overlap in separate processes. These are spawned rather than forked, since forking the
+        multithreaded TF process is not safe: each one imports this module (and TF) and receives a copy of this
+        loader once, when the loader is created.
+        """
+        return multiprocessing.get_context("spawn").Pool(
+            self.num_parallel_reads, initializer=_init_reader_worker, initargs=(self,))
+
+    def close(self):
+        """Terminates the reader processes, if any were started, and the staging of the files."""
+        if self.file_stager is not None:
+            self.file_stager.stop()
+        if self.reader_pool is not None:
+            self.reader_pool.terminate()
+            self.reader_pool.join()
+            self.reader_pool = None
+
+    def parallel_batches(self):
+        """
+        Yields the batches read by the reader processes, keeping at most ``reader_queue_size`` of them in flight.
+
+        In deterministic mode the batches come out in the order of ``get_batch_units``; otherwise whichever batch
+        is ready first is yielded, so that one slow file does not stall the others.
+        """
+        inputs = self.get_read_inputs()
+        units = iter(self.get_batch_units())
+        pending = collections.deque()
+        for unit in itertools.islice(units, self.reader_queue_size):
+            pending.append(self.reader_pool.apply_async(_process_batch_in_worker, (unit, inputs)))
+        while pending:
+            result = pending[0]
+            if not self.deterministic_reads:
+                result = next((r for r in pending if r.ready()), result)
+            pending.remove(result)
+            batch = result.get()
+            for unit in itertools.islice(units, 1):
+                pending.append(self.reader_pool.apply_async(_process_batch_in_worker, (unit, inputs)))
+            yield batch
+
+    def get_file_stager(self):
+        """
+        Returns the stager that copies the files of the dataset to "staging_dir" (e.g. "$SLURM_TMPDIR") while they
+        are being read, or None if no staging directory is configured. "staging_max_gb" limits the staged size.
+        """
+        staging_dir = self.config.get("staging_dir")
+        if staging_dir is None:
+            return None
+        dataset_name = os.path.basename(os.path.normpath(self.data_folder))
+        staging_dir = os.path.join(os.path.expandvars(staging_dir), dataset_name)
+        max_gb = self.config.get("staging_max_gb")
+        max_bytes = None if max_gb is None else int(max_gb * 2 ** 30)
+        return FileStager(self.data_files_list, staging_dir, max_bytes, self.logger)
+
+    def resolve_path(self, path):
+        return path if self.file_stager is None else self.file_stager.resolve(path)
+
+    def get_cache_fingerprint(self):
+        """Hash of the source files (name, size and modification time) and of the settings that shape the batches."""
+        fingerprint = hashlib.md5()
+        paths = list(self.data_files_list)
+        if self.shard_index is not None:
+            paths.append(os.path.join(self.data_folder, SHARD_INDEX_FILE_NAME))
+        for path in paths:
+            stat = os.stat(path)
+            fingerprint.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+        parameters = {
+            "station_codes": sorted((name.decode("ascii"), code) for name, code in self.station_codes.items()),
+            "shard_batch_size": getattr(self, "shard_batch_size", None),
+            "required_inputs": sorted(self.required_inputs),
+        }
+        fingerprint.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+        return fingerprint.hexdigest()
+
+    def estimate_dataset_size(self):
+        """Estimates the size of the decoded dataset in bytes, assuming all the batches are as large as the first."""
+        if not self.data_files_list:
+            return 0
+        with h5py.File(self.data_files_list[0], 'r') as h5_data:
+            images_shape = h5_data["images"].shape
+        nb_samples = len(self.shard_index["shard"]) if self.shard_index is not None \
+            else images_shape[0] * self.nb_batches
+        if "images" not in self.required_inputs:
+            images_shape = images_shape[:1]
+        # decoded images are float32; the labels, one-hot vectors and time features are comparatively small
+        return nb_samples * (int(np.prod(images_shape[1:])) + 64) * 4
+
+    def get_batch_cache(self):
+        """
+        Returns the cache that holds the decoded batches after a first full pass, or None if caching is disabled.
+
+        "data_loader_cache" is one of "none" (default), "memory", "memmap" or "auto"; "auto" keeps the batches in
+        memory when the dataset fits in "data_loader_cache_memory_mb" and exports them to a memmap store otherwise.
+        Memmap stores live in "data_loader_cache_dir" and are named after the fingerprint of the source files, so
+        any change to these files or to the loader settings invalidates them.
+        """
+        cache_mode = self.config.get("data_loader_cache", "none")
+        if cache_mode == "none":
+            return None
+        if cache_mode == "auto":
+            max_memory = self.config.get("data_loader_cache_memory_mb", 4096) * 2 ** 20
+            cache_mode = "memory" if self.estimate_dataset_size() <= max_memory else "memmap"
+        if cache_mode == "memory":
+            return MemoryBatchCache()
+        assert cache_mode == "memmap", f"invalid data_loader_cache: {cache_mode}"
+
+        cache_dir = os.path.expandvars(self.config.get("data_loader_cache_dir",
+                                                       os.path.join(tempfile.gettempdir(), "batch_cache")))
+        os.makedirs(cache_dir, exist_ok=True)
+        dataset_name = os.path.basename(os.path.normpath(self.data_folder))
+        store_name = f"{dataset_name}_{self.get_cache_fingerprint()}"
+        # stores of previous versions of this dataset are stale
+        for path in glob.glob(os.path.join(cache_dir, dataset_name + "_*")):
+            name = os.path.basename(path)
+            if re.fullmatch(re.escape(dataset_name) + r"_[0-9a-f]{32}(\.tmp)?", name) and \
+                    name not in (store_name, store_name + ".tmp"):
+                self.logger.debug(f"Removing stale batch cache {path}")
+                shutil.rmtree(path, ignore_errors=True)
+        return MemmapBatchCache(os.path.join(cache_dir, store_name))
+
+    def skip_inputs(self, names):
+        """
+        Stops reading the given inputs from the next epoch on (e.g. the features of a model trained on images only
+        during its first epochs); an empty list reads all the required inputs again
+        """
+        self.skipped_inputs = set(names)
+
+    def get_read_inputs(self):
+        return self.required_inputs - self.skipped_inputs
+
+    def data_generator_fn(self):
+        if self.batch_cache is None:
+            yield from self.source_batches()
+        elif self.batch_cache.is_complete():
+            yield from self.batch_cache.read_batches()
+        elif self.skipped_inputs:
+            # the cache must hold all the required inputs
+            yield from self.source_batches()
+        else:
+            yield from self.batch_cache.write_batches(self.source_batches())
+
+    def source_batches(self):
+        # the legacy, compact and sharded batch file layouts are all supported
+        if self.num_parallel_reads > 1:
+            yield from self.parallel_batches()
+            return
+
+        inputs = self.get_read_inputs()
+        shard_readers = {}
+        try:
+            for unit in self.get_batch_units():
+                yield self.process_batch(unit, shard_readers, inputs)
+        finally:
+            for shard_reader in shard_readers.values():
+                shard_reader.close()
 
     def get_data_loader(self):
         '''
@@ -110,3 +664,25 @@ class DataLoader():
             by ``target_sequences``.
         '''
         return self.data_loader
+
+    def get_input_signature(self):
+        """
+        Returns:
+            The ``tf.TensorSpec`` of the model inputs and of the targets of the batches, with an unknown batch size,
+            used to trace the training steps once for all the batches.
+        """
+        nb_offsets = len(self.target_time_offsets)
+        if "images" in self.required_inputs:
+            image_shape = (self.config["input_seq_length"], self.config["image_size_m"], self.config["image_size_n"],
+                           self.config["nb_channels"])
+        else:
+            image_shape = (1,)
+        inputs = (
+            tf.TensorSpec((None,) + image_shape, tf.float32, name="images"),
+            tf.TensorSpec((None, nb_offsets), tf.float32, name="clearsky_GHI"),
+            tf.TensorSpec((None, nb_offsets), tf.float32, name="true_GHI"),
+            tf.TensorSpec((None, nb_offsets), tf.bool, name="night_flags"),
+            tf.TensorSpec((None, len(self.station_onehots)), tf.float32, name="station_id_onehot"),
+            tf.TensorSpec((None, 4), tf.float32, name="date_vector"),
+        )
+        return inputs, tf.TensorSpec((None, nb_offsets), tf.float32, name="targets")
@@ -2,6 +2,7 @@ import argparse
 import datetime
 import json
 import os
+import time
 import typing
 
 import pandas as pd
@@ -10,6 +11,7 @@ import tensorflow as tf
 import tqdm
 
 from data_loader import DataLoader
+from training_loop import precision_policy_scope
 from training_loop_launcher import select_model
 from create_batch_files import create_and_save_batches
 
@@ -59,23 +61,36 @@ def prepare_dataloader(
     # WE ARE PROVIDING YOU WITH A DUMMY DATA GENERATOR FOR DEMONSTRATION PURPOSES.
     # MODIFY EVERYTHING IN IN THIS BLOCK AS YOU SEE FIT
 
-    base_folder_path = os.path.expandvars(config["val_data_folder"])
-    data_folder = os.path.join(base_folder_path, list(stations.keys())[0])
-
-    DL = DataLoader(dataframe,
-                    target_datetimes,
-                    stations,
-                    target_time_offsets,
-                    config,
-                    data_folder=data_folder)
-
-    data_loader = DL.get_data_loader()
+    data_loader = create_station_dataloader(dataframe, target_datetimes, stations, target_time_offsets,
+                                            config).get_data_loader()
 
     # MODIFY ABOVE
 
     return data_loader
 
 
+def create_station_dataloader(
+        dataframe: pd.DataFrame,
+        target_datetimes: typing.List[datetime.datetime],
+        stations: typing.Dict[typing.AnyStr, typing.Tuple[float, float, float]],
+        target_time_offsets: typing.List[datetime.timedelta],
+        config: typing.Dict[typing.AnyStr, typing.Any],
+) -> DataLoader:
+    """Returns the ``DataLoader`` behind ``prepare_dataloader``, to be closed by the caller once the predictions are
+    generated."""
+    base_folder_path = os.path.expandvars(config["val_data_folder"])
+    data_folder = os.path.join(base_folder_path, list(stations.keys())[0])
+
+    # predictions must come out in the order of target_datetimes, whatever the reader setup
+    return DataLoader(dataframe,
+                      target_datetimes,
+                      stations,
+                      target_time_offsets,
+                      dict(config, data_loader_deterministic=True, shuffle_buffer_size=0),
+                      data_folder=data_folder,
+                      required_inputs=select_model(config).REQUIRED_INPUTS)
+
+
 def prepare_model(
         stations: typing.Dict[typing.AnyStr, typing.Tuple[float, float, float]],
         target_time_offsets: typing.List[datetime.timedelta],
@@ -98,6 +113,13 @@ def prepare_model(
 
     # MODIFY BELOW
 
+    if config.get("quantized_model_file"):
+        # int8 artifact of export_quantized_model.py instead of the Keras model
+        from export_quantized_model import QuantizedModel
+        print("Loading quantized model from {}".format(config["quantized_model_file"]))
+        return QuantizedModel(config["quantized_model_file"], config["max_k_ghi"],
+                              num_threads=config.get("tflite_num_threads"))
+
     MainModel = select_model(config)
 
     model = MainModel(stations, target_time_offsets, config, return_ghi_only=True)
@@ -150,10 +172,15 @@ def generate_all_predictions(
         stations = {station_name: target_stations[station_name]}
         print(f"preparing data loader & model for station '{station_name}' ({station_idx + 1}/{len(target_stations)})")
 
-        data_loader = prepare_dataloader(dataframe, target_datetimes, stations, target_time_offsets, user_config)
-
-        model = prepare_model(stations, target_time_offsets, user_config)
-        station_preds = generate_predictions(data_loader, model, pred_count=len(target_datetimes))
+        DL = create_station_dataloader(dataframe, target_datetimes, stations, target_time_offsets, user_config)
+        try:
+            # the precision policy of the config only applies to this model, not to the next ones (e.g. the
+            # float32 reference of the precision check)
+            with precision_policy_scope(user_config):
+                model = prepare_model(stations, target_time_offsets, user_config)
+            station_preds = generate_predictions(DL.get_data_loader(), model, pred_count=len(target_datetimes))
+        finally:
+            DL.close()
 
         # print("harman in prediction: ",(station_preds), (target_datetimes))
         assert len(station_preds) == len(target_datetimes), "number of predictions mismatch with requested datetimes"
@@ -206,6 +233,40 @@ def parse_nighttime_flags(
     return np.concatenate(flags, axis=0)
 
 
+def get_horizons_rmse(predictions: np.ndarray, gt: np.ndarray) -> np.ndarray:
+    """RMSE of every horizon of (station, datetime, horizon) predictions."""
+    return np.sqrt(np.nanmean(np.square(predictions - gt), axis=(0, 1)))
+
+
+def compare_predictions(
+        name: str,
+        predictions: np.ndarray,
+        prediction_time: float,
+        reference_name: str,
+        reference_predictions: np.ndarray,
+        reference_time: float,
+        gt: np.ndarray,
+        target_time_offsets: typing.List[datetime.timedelta],
+        rmse_tolerance: float,
+) -> bool:
+    """Prints the RMSE of every horizon and the prediction time of two models on the same data, with the deltas.
+
+    Returns:
+        False if the RMSE of a horizon is worse than the reference by more than ``rmse_tolerance``.
+    """
+    rmse = get_horizons_rmse(predictions, gt)
+    reference_rmse = get_horizons_rmse(reference_predictions, gt)
+    for horizon_offset, horizon_rmse, horizon_reference_rmse in zip(target_time_offsets, rmse, reference_rmse):
+        print(f"horizon +{horizon_offset} RMSE: {reference_name} = {horizon_reference_rmse:.02f}, "
+              f"{name} = {horizon_rmse:.02f} (delta {horizon_rmse - horizon_reference_rmse:+.02f})")
+    print(f"prediction time: {reference_name} = {reference_time:.02f}s, {name} = {prediction_time:.02f}s "
+          f"(delta {prediction_time - reference_time:+.02f}s)")
+    within_tolerance = bool(np.all(rmse - reference_rmse <= rmse_tolerance))
+    if not within_tolerance:
+        print(f"WARNING: {name} RMSE regression above {rmse_tolerance:.02f} wrt {reference_name}")
+    return within_tolerance
+
+
 def main(
         preds_output_path: typing.AnyStr,
         admin_config_path: typing.AnyStr,
@@ -250,8 +311,10 @@ def main(
         assert len(predictions) % len(target_stations) == 0
         predictions = np.asarray([float(ghi) for p in predictions for ghi in p.split(",")])
     else:
+        prediction_start = time.perf_counter()
         predictions = generate_all_predictions(target_stations, target_datetimes,
                                                target_time_offsets, dataframe, user_config)
+        prediction_time = time.perf_counter() - prediction_start
         with open(preds_output_path, "w") as fd:
             for pred in predictions:
                 fd.write(",".join([f"{v:0.03f}" for v in pred.tolist()]) + "\n")
@@ -279,12 +342,25 @@ def main(
     stations_rmse = np.sqrt(np.nanmean(squared_errors, axis=(1, 2)))
     for station_idx, (station_name, station_rmse) in enumerate(zip(target_stations, stations_rmse)):
         print(f"station '{station_name}' RMSE = {station_rmse:.02f}")
-    horizons_rmse = np.sqrt(np.nanmean(squared_errors, axis=(0, 1)))
+    horizons_rmse = get_horizons_rmse(predictions, gt)
     for horizon_idx, (horizon_offset, horizon_rmse) in enumerate(zip(target_time_offsets, horizons_rmse)):
         print(f"horizon +{horizon_offset} RMSE = {horizon_rmse:.02f}")
     overall_rmse = np.sqrt(np.nanmean(squared_errors))
     print(f"overall RMSE = {overall_rmse:.02f}")
 
+    precision = "int8" if user_config.get("quantized_model_file") else user_config.get("precision_policy", "float32")
+    if precision != "float32" and user_config.get("check_precision_regression", False) and \
+            not admin_config.get("bypass_predictions_path"):
+        # accuracy regression check of the reduced precision (or quantized) model against the float32 Keras model
+        reference_config = dict(user_config, precision_policy="float32", quantized_model_file=None)
+        reference_start = time.perf_counter()
+        reference_predictions = generate_all_predictions(target_stations, target_datetimes, target_time_offsets,
+                                                         dataframe, reference_config)
+        reference_time = time.perf_counter() - reference_start
+        compare_predictions(precision, predictions, prediction_time,
+                            "float32", reference_predictions.reshape(predictions.shape), reference_time,
+                            gt, target_time_offsets, user_config.get("precision_rmse_tolerance", 1.0))
+
     if stats_output_path is not None:
         # we remove nans to avoid issues in the stats comparison script, and focus on daytime predictions
         squared_errors = squared_errors[~np.isnan(gt) & day]
@@ -0,0 +1,186 @@
+import os
+import sys
+import typing
+import inspect
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+from data_loader import DataLoader, INPUT_NAMES
+from model_logging import get_logger
+from training_loop import k_to_true_ghi
+from training_loop_launcher import load_file, select_model
+
+logger = get_logger()
+
+
+def get_predict_function(model, input_signature):
+    """
+    Returns:
+        The k predictions of the model (built with ``return_ghi_only=False``) as a graph of the six named model
+        inputs, the signature of the exported artifact. The k -> GHI conversion is left out, to be done in float32
+    """
+    @tf.function(input_signature=input_signature)
+    def predict(images, clearsky_GHI, true_GHI, night_flags, station_id_onehot, date_vector):
+        k, _ = model((images, clearsky_GHI, true_GHI, night_flags, station_id_onehot, date_vector), training=False)
+        return k
+    return predict
+
+
+def get_input_name(tensor_name):
+    """Name in INPUT_NAMES of a TFLite input tensor (e.g. "serving_default_images:0" or "images")"""
+    tensor_name = tensor_name.split(":")[0]
+    for name in INPUT_NAMES:
+        if tensor_name == name or tensor_name.endswith("_" + name):
+            return name
+    raise ValueError(f"unknown input tensor in the quantized model: {tensor_name}")
+
+
+def get_representative_dataset(data_loader, nb_samples, input_names):
+    """
+    Calibration samples of the quantization, one at a time, read from the batch files of the data loader. Samples
+    are lists of arrays in the order of the TFLite inputs (``input_names``), which is not the order of the signature
+    """
+    def representative_dataset():
+        samples = (sample for minibatch in data_loader.get_data_loader()
+                   for sample in zip(*(t.numpy() for t in minibatch[:-1])))
+        for sample in itertools.islice(samples, nb_samples):
+            arrays = dict(zip(INPUT_NAMES, sample))
+            yield [arrays[name][np.newaxis] for name in input_names]
+    return representative_dataset
+
+
+def get_converter(predict, model):
+    # the model is only kept alive by the converter of the TF versions that accept it
+    if "trackable_obj" in inspect.signature(tf.lite.TFLiteConverter.from_concrete_functions).parameters:
+        return tf.lite.TFLiteConverter.from_concrete_functions([predict], model)
+    return tf.lite.TFLiteConverter.from_concrete_functions([predict])
+
+
+def convert_to_int8_tflite(model, input_signature, data_loader, nb_calibration_samples):
+    """
+    Converts the model to TFLite with int8 weights and activations, the ranges of the activations being calibrated
+    on ``nb_calibration_samples`` samples of the data loader. The inputs and outputs stay float32, and the operations
+    without int8 kernels (e.g. Conv3D) are kept in float32.
+
+    Returns:
+        The serialized TFLite model
+    """
+    # the model is built (and its checkpoint restored) by an eager call, so that its weights exist before tracing
+    model(tuple(tf.zeros((1,) + tuple(spec.shape[1:]), spec.dtype) for spec in input_signature), training=False)
+    # the weights are frozen explicitly: the converter leaves the Keras 3 variables as TFLite variables, which the
+    # calibration cannot read
+    predict = convert_variables_to_constants_v2(get_predict_function(model, input_signature).get_concrete_function())
+    # the calibration feeds the samples in the order of the TFLite inputs, read from a float32 conversion
+    float_interpreter = tf.lite.Interpreter(model_content=get_converter(predict, model).convert())
+    input_names = [get_input_name(detail["name"]) for detail in float_interpreter.get_input_details()]
+
+    converter = get_converter(predict, model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = get_representative_dataset(data_loader, nb_calibration_samples, input_names)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    return converter.convert()
+
+
+class QuantizedModel():
+    """
+    Inference with a model exported by export_quantized_model, called like the Keras model built with
+    ``return_ghi_only=True`` on the tuple of model inputs
+    """
+
+    def __init__(self, model_path, max_k_ghi, num_threads=None):
+        assert os.path.isfile(model_path), f"invalid quantized model file: {model_path}"
+        self.max_k_ghi = max_k_ghi
+        if num_threads is not None and "num_threads" in inspect.signature(tf.lite.Interpreter).parameters:
+            self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        else:
+            if num_threads is not None:
+                logger.warning(f"this TensorFlow version cannot set the TFLite threads, {num_threads} ignored")
+            self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        # inputs are matched by name since TFLite does not keep the order of the signature
+        self.input_indices = {get_input_name(detail["name"]): detail["index"]
+                              for detail in self.interpreter.get_input_details()}
+        # single output: the k predictions
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def __call__(self, inputs):
+        arguments = {name: np.asarray(array) for name, array in zip(INPUT_NAMES, inputs)}
+        batch_size = len(arguments["clearsky_GHI"])
+        if batch_size != self.batch_size:
+            # the tensors are allocated again only when the batch size changes (e.g. for the last batch)
+            for name, index in self.input_indices.items():
+                self.interpreter.resize_tensor_input(index, arguments[name].shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+        for name, index in self.input_indices.items():
+            self.interpreter.set_tensor(index, arguments[name])
+        self.interpreter.invoke()
+        k = self.interpreter.get_tensor(self.output_index)
+        return k_to_true_ghi(self.max_k_ghi, k, inputs[1])
+
+
+def export_quantized_model(
+        user_config_path: typing.AnyStr,
+        train_config_path: typing.AnyStr,
+        output_path: typing.AnyStr,
+        data_folder: typing.Optional[typing.AnyStr] = None,
+        nb_calibration_samples: int = 512,
+) -> None:
+    """
+    Converts the trained model of the user config ("model_file") into an int8 TFLite artifact, calibrated on the
+    samples of the batch files of the training set
+    """
+    user_config = load_file(user_config_path, "user")
+    train_config = load_file(train_config_path, "training")
+    stations = train_config["stations"]
+    target_time_offsets = [pd.Timedelta(d).to_pytimedelta() for d in train_config["target_time_offsets"]]
+    if data_folder is None:
+        data_folder = os.path.expandvars(user_config["train_data_folder"])
+
+    MainModel = select_model(user_config)
+    assert MainModel.TRAINING_REQUIRED, "only trained models can be quantized"
+    # the recurrent layers are unrolled since TFLite has no int8 kernels for their loops
+    model = MainModel(stations, target_time_offsets, dict(user_config, unroll_lstm=True), return_ghi_only=False)
+    weights_file = user_config["model_file"]
+    print("Loading weights from {}".format(weights_file))
+    assert os.path.exists(weights_file), "Model not trained!"
+    model.load_weights(weights_file)
+
+    data_loader = DataLoader(pd.DataFrame(), [], stations, target_time_offsets, user_config, data_folder,
+                             required_inputs=MainModel.REQUIRED_INPUTS)
+    try:
+        input_signature, _ = data_loader.get_input_signature()
+        tflite_model = convert_to_int8_tflite(model, input_signature, data_loader, nb_calibration_samples)
+    finally:
+        data_loader.close()
+
+    with open(output_path, "wb") as fd:
+        fd.write(tflite_model)
+    print("Quantized model saved to {} ({:.1f} MB)".format(output_path, len(tflite_model) / 2 ** 20))
+
+
+if __name__ == "__main__":
+    logger.info(str(sys.argv))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--user_cfg_path", type=str, default="eval_user_cfg_lstm.json",
+                        help="path to the JSON config file used to store user model/dataloader parameters")
+    parser.add_argument("-t", "--train_cfg_path", type=str, required=True,
+                        help="path to the JSON config file of the training set, for its stations and time offsets")
+    parser.add_argument("-o", "--output_path", type=str, default="../model/my_model_int8.tflite",
+                        help="path of the quantized TFLite model")
+    parser.add_argument("-d", "--data_folder", type=str, default=None,
+                        help="folder of the calibration batch files (default: train_data_folder of the user config)")
+    parser.add_argument("-n", "--calibration_samples", type=int, default=512,
+                        help="number of samples used to calibrate the quantization")
+    args = parser.parse_args()
+    export_quantized_model(
+        user_config_path=args.user_cfg_path,
+        train_config_path=args.train_cfg_path,
+        output_path=args.output_path,
+        data_folder=args.data_folder,
+        nb_calibration_samples=args.calibration_samples,
+    )
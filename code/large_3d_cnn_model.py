@@ -3,11 +3,16 @@ import datetime
 import tensorflow as tf
 from model_logging import get_logger
 from training_loop import k_to_true_ghi
+from compute_statistics import get_feature_normalization
 
 
 class MainModel(tf.keras.Model):
 
     TRAINING_REQUIRED = True
+    # inputs read by the DataLoader (see data_loader.INPUT_NAMES); the station IDs are zeroed in ``call``
+    REQUIRED_INPUTS = ("images", "clearsky_GHI", "date_vector")
+    # inputs unused when training on image data only
+    IMAGE_ONLY_UNUSED_INPUTS = ("date_vector",)
 
     def __init__(
         self,
@@ -24,7 +29,8 @@ class MainModel(tf.keras.Model):
                 parameters are loaded automatically if the user provided a JSON file in their submission. Submitting
                 such a JSON file is completely optional, and this argument can be ignored if not needed.
         """
-        super(MainModel, self).__init__()
+        # the inputs and the k -> GHI conversion stay in float32 whatever the precision policy of the layers
+        super(MainModel, self).__init__(dtype="float32")
         self.stations = stations
         self.target_time_offsets = target_time_offsets
         self.config = config
@@ -36,6 +42,13 @@ class MainModel(tf.keras.Model):
         self.logger = get_logger()
         self.logger.debug("Model start")
 
+        # the layers below compute in the precision policy set by the caller (see training_loop.set_precision_policy);
+        # BatchNormalization keeps float32 statistics and normalizes in float32, and the output layer is kept in float32
+
+        # Refer to report for the default mean/std choices
+        self.clearsky_mean, self.clearsky_std = \
+            get_feature_normalization(self.config, "clearsky_GHI", default_mean=454.5, default_std=293.9)
+
         nb_channels = self.config["nb_channels"]
         image_size_m = self.config["image_size_m"]
         image_size_n = self.config["image_size_n"]
@@ -116,7 +129,8 @@ class MainModel(tf.keras.Model):
         # Output layer
         self.dense_3 = tf.keras.layers.Dense(
             len(self.target_time_offsets),
-            activation=None
+            activation=None,
+            dtype="float32"
         )
 
     def call(self, inputs, training=False, use_image_data_only=False):
@@ -134,15 +148,14 @@ class MainModel(tf.keras.Model):
         clearsky_GHIs = inputs[1]
 
         # Zero; We decided not to use onehot station Ids
-        station_id_onehot = tf.zeros(inputs[4].shape)
+        station_id_onehot = tf.zeros_like(inputs[4])
 
         if use_image_data_only:
-            date_vector = tf.zeros(inputs[5].shape)
-            normalized_clearsky_GHIs = tf.zeros(inputs[1].shape)
+            date_vector = tf.zeros_like(inputs[5])
+            normalized_clearsky_GHIs = tf.zeros_like(inputs[1])
         else:
             date_vector = inputs[5]
-            # Refer to report for mean/std choices
-            normalized_clearsky_GHIs = (clearsky_GHIs - 454.5) / 293.9
+            normalized_clearsky_GHIs = (clearsky_GHIs - self.clearsky_mean) / self.clearsky_std
 
         x = self.conv3d_1(images)
         x = self.bn_1(x, training=training)
@@ -176,7 +189,8 @@ class MainModel(tf.keras.Model):
         x = self.pool_3(x)
 
         x = self.flatten(x)
-        x = tf.concat((x, station_id_onehot, normalized_clearsky_GHIs, date_vector), axis=1)
+        features = tf.concat((station_id_onehot, normalized_clearsky_GHIs, date_vector), axis=1)
+        x = tf.concat((x, tf.cast(features, x.dtype)), axis=1)
 
         x = self.dense_1(x)
         x = self.bn_7(x, training=training)
@@ -1,6 +1,7 @@
 import os
 import tqdm
 import json
+import contextlib
 import typing
 import datetime
 import numpy as np
@@ -9,7 +10,6 @@ import tensorflow as tf
 from data_loader import DataLoader
 from model_logging import get_logger, get_summary_writers, do_code_profiling
 from tensorboard.plugins.hparams import api as hp
-import glob
 
 logger = get_logger()
 
@@ -28,37 +28,203 @@ def ghi_to_k(max_k_ghi, true_ghi, clearsky_ghi):
     return k
 
 
-def mask_nighttime_predictions(*args, daytime_flag):
-    weight = tf.reduce_sum(tf.cast(daytime_flag, tf.float32))
-    outputs = []
-    for arg in args:
-        outputs += [tf.boolean_mask(tensor=arg, mask=daytime_flag)]
-    return outputs + [weight]
+# first TensorFlow version with the mixed precision policies (in tf.keras.mixed_precision.experimental until 2.4)
+MIN_MIXED_PRECISION_TF_VERSION = (2, 1)
+
+
+def get_tf_version():
+    return tuple(int(v) for v in tf.__version__.split(".")[:2])
+
+
+def get_precision_policy(user_config):
+    """
+    Returns:
+        The "precision_policy" of the user config ("float32" by default), after checking that the installed
+        TensorFlow supports it
+    """
+    policy = user_config.get("precision_policy", "float32")
+    if policy != "float32" and get_tf_version() < MIN_MIXED_PRECISION_TF_VERSION:
+        raise ValueError("precision_policy \"{}\" requires TensorFlow {} or later, found {}".format(
+            policy, ".".join(map(str, MIN_MIXED_PRECISION_TF_VERSION)), tf.__version__))
+    return policy
+
+
+def get_mixed_precision_api():
+    """tf.keras.mixed_precision, or its experimental module before TF 2.4 (with set_policy instead of
+    set_global_policy, and a loss_scale argument to LossScaleOptimizer)"""
+    mixed_precision = tf.keras.mixed_precision
+    if hasattr(mixed_precision, "set_global_policy"):
+        return mixed_precision
+    return mixed_precision.experimental
+
+
+def set_precision_policy(user_config):
+    """
+    Sets the Keras precision policy of the layers created next from the "precision_policy" of the user config:
+    "float32" (default), or "mixed_bfloat16" / "mixed_float16" to compute in reduced precision with float32 variables
+    where the device supports it (bfloat16 on recent CPUs, float16 on GPUs). The policy is global to the process: it
+    is left untouched for "float32", and should be restored with restore_precision_policy once the models are built.
+
+    Returns:
+        The previous policy, or None if it was left untouched
+    """
+    policy = get_precision_policy(user_config)
+    if policy == "float32":
+        return None
+    mixed_precision = get_mixed_precision_api()
+    previous_policy = mixed_precision.global_policy()
+    if hasattr(mixed_precision, "set_global_policy"):
+        mixed_precision.set_global_policy(policy)
+    else:
+        mixed_precision.set_policy(policy)
+    return previous_policy
+
+
+def restore_precision_policy(previous_policy):
+    """Restores the policy returned by set_precision_policy"""
+    if previous_policy is None:
+        return
+    mixed_precision = get_mixed_precision_api()
+    if hasattr(mixed_precision, "set_global_policy"):
+        mixed_precision.set_global_policy(previous_policy)
+    else:
+        mixed_precision.set_policy(previous_policy)
+
+
+@contextlib.contextmanager
+def precision_policy_scope(user_config):
+    """Builds the models created in its scope with the precision policy of the user config"""
+    previous_policy = set_precision_policy(user_config)
+    try:
+        yield
+    finally:
+        restore_precision_policy(previous_policy)
+
+
+def get_optimizer(learning_rate, user_config):
+    """Adam optimizer, wrapped in a LossScaleOptimizer for float16 training so that small gradients do not underflow"""
+    optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+    if get_precision_policy(user_config) == "mixed_float16":
+        # bfloat16 has the range of float32 and needs no loss scaling
+        mixed_precision = get_mixed_precision_api()
+        if hasattr(mixed_precision, "set_global_policy"):
+            optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+        else:
+            optimizer = mixed_precision.LossScaleOptimizer(optimizer, "dynamic")
+    return optimizer
+
+
+def is_loss_scale_optimizer(optimizer):
+    loss_scale_optimizer = getattr(get_mixed_precision_api(), "LossScaleOptimizer", None)
+    return loss_scale_optimizer is not None and isinstance(optimizer, loss_scale_optimizer)
+
+
+def scale_loss(optimizer, loss):
+    if not is_loss_scale_optimizer(optimizer):
+        return loss
+    if hasattr(optimizer, "get_scaled_loss"):
+        return optimizer.get_scaled_loss(loss)
+    # Keras 3
+    return optimizer.scale_loss(loss)
+
+
+def unscale_gradients(optimizer, gradients):
+    if is_loss_scale_optimizer(optimizer) and hasattr(optimizer, "get_unscaled_gradients"):
+        return optimizer.get_unscaled_gradients(gradients)
+    # Keras 3 loss scale optimizers unscale the gradients in apply_gradients
+    return gradients
+
+
+def get_daytime_weights(daytime_flag):
+    """Weights of the predictions in the loss and metrics: 1 for the daytime GHIs, 0 for the nighttime ones"""
+    return tf.cast(daytime_flag, tf.float32)
+
+
+def weighted_loss(loss_fn, y_true, y_pred, weights):
+    """
+    Average loss over the weighted (daytime) elements. Unlike boolean masking, the shapes of all the tensors stay
+    static, so that the compiled steps are traced once. ``loss_fn`` must use the "sum" reduction.
+    """
+    # a trailing axis of size 1 gives the loss of every element, weighted by the matching weight
+    loss = loss_fn(y_true[..., tf.newaxis], y_pred[..., tf.newaxis], sample_weight=weights)
+    return tf.math.divide_no_nan(loss, tf.reduce_sum(weights))
 
 
 def train_step(model, optimizer, loss_fn, max_k_ghi, x_train, y_train, use_image_data_only):
     k_train = ghi_to_k(max_k_ghi, true_ghi=y_train, clearsky_ghi=x_train[1])
+    weights = get_daytime_weights(x_train[3])
     with tf.GradientTape() as tape:
         k_pred, y_pred = model(x_train, training=True, use_image_data_only=use_image_data_only)
-        daytime_flag = tf.squeeze(x_train[3])
-        k_train = tf.squeeze(k_train)
-        k_pred, k_train, y_pred, y_train, weight = \
-            mask_nighttime_predictions(k_pred, k_train, y_pred, y_train, daytime_flag=daytime_flag)
-        loss = loss_fn(k_train, k_pred)
-    gradient = tape.gradient(loss, model.trainable_variables)
+        loss = weighted_loss(loss_fn, k_train, k_pred, weights)
+        scaled_loss = scale_loss(optimizer, loss)
+    gradient = unscale_gradients(optimizer, tape.gradient(scaled_loss, model.trainable_variables))
     optimizer.apply_gradients(zip(gradient, model.trainable_variables))
-    return loss, y_train, y_pred, weight
+    return loss, y_train, y_pred, weights
 
 
 def test_step(model, loss_fn, max_k_ghi, x_test, y_test, use_image_data_only):
     k_test = ghi_to_k(max_k_ghi, true_ghi=y_test, clearsky_ghi=x_test[1])
+    weights = get_daytime_weights(x_test[3])
     k_pred, y_pred = model(x_test, use_image_data_only=use_image_data_only)
-    daytime_flag = tf.squeeze(x_test[3])
-    k_test = tf.squeeze(k_test)
-    y_pred, y_test, k_pred, k_test, weight = \
-        mask_nighttime_predictions(y_pred, y_test, k_pred, k_test, daytime_flag=daytime_flag)
-    loss = loss_fn(k_test, k_pred)
-    return loss, y_test, y_pred, weight
+    loss = weighted_loss(loss_fn, k_test, k_pred, weights)
+    return loss, y_test, y_pred, weights
+
+
+def compile_step(step_fn, input_signature, user_config):
+    """
+    Traces a step function of (inputs, targets) as a graph with a fixed input signature, XLA compiled if
+    "jit_compile" is set in the user config. "run_eagerly" returns the step function as is, for debugging.
+    """
+    if user_config.get("run_eagerly", False):
+        return step_fn
+    if not user_config.get("jit_compile", False):
+        return tf.function(step_fn, input_signature=input_signature)
+    try:
+        return tf.function(step_fn, input_signature=input_signature, jit_compile=True)
+    except TypeError:
+        pass
+    try:
+        # named experimental_compile before TensorFlow 2.5
+        return tf.function(step_fn, input_signature=input_signature, experimental_compile=True)
+    except TypeError:
+        # TensorFlow 2.0 cannot compile a tf.function with XLA
+        logger.warning("jit_compile requires TensorFlow 2.1 or later, found {}: the step is compiled without XLA"
+                       .format(tf.__version__))
+        return tf.function(step_fn, input_signature=input_signature)
+
+
+def get_step_functions(model, optimizer, loss_fn, max_k_ghi, input_signature, user_config):
+    """
+    Returns:
+        The train and test steps of the model, with the signature ``step(x, y, use_image_data_only)``, compiled
+        once per value of ``use_image_data_only`` (see compile_step).
+    """
+    compiled_steps = {}
+
+    def get_compiled_step(step_name, use_image_data_only):
+        if (step_name, use_image_data_only) not in compiled_steps:
+            if step_name == "train":
+                def step_fn(x, y):
+                    return train_step(model, optimizer, loss_fn, max_k_ghi, x, y, use_image_data_only)
+            else:
+                def step_fn(x, y):
+                    return test_step(model, loss_fn, max_k_ghi, x, y, use_image_data_only)
+            compiled_steps[step_name, use_image_data_only] = compile_step(step_fn, input_signature, user_config)
+        return compiled_steps[step_name, use_image_data_only]
+
+    def compiled_train_step(x_train, y_train, use_image_data_only):
+        return get_compiled_step("train", use_image_data_only)(x_train, y_train)
+
+    def compiled_test_step(x_test, y_test, use_image_data_only):
+        return get_compiled_step("test", use_image_data_only)(x_test, y_test)
+
+    return compiled_train_step, compiled_test_step
+
+
+def check_step_numerics(**tensors):
+    """Raises an InvalidArgumentError if any of the given step outputs holds NaN or infinite values"""
+    for name, tensor in tensors.items():
+        tf.debugging.check_numerics(tensor, "{} is not finite".format(name))
 
 
 def manage_model_start_time(ignore_checkpoints):
@@ -116,13 +282,16 @@ def train(
     """Trains and saves the model to file"""
 
     # Import the training and validation data loaders, import the model
+    # (the night flags are also needed to mask the loss)
+    required_inputs = MainModel.REQUIRED_INPUTS + ("night_flags",)
     Train_DL = DataLoader(
         dataframe,
         tr_datetimes,
         tr_stations,
         tr_time_offsets,
         user_config,
-        data_folder=os.path.expandvars(user_config["train_data_folder"])
+        data_folder=os.path.expandvars(user_config["train_data_folder"]),
+        required_inputs=required_inputs
     )
     Val_DL = DataLoader(
         dataframe,
@@ -130,7 +299,8 @@ def train(
         val_stations,
         val_time_offsets,
         user_config,
-        data_folder=os.path.expandvars(user_config["val_data_folder"])
+        data_folder=os.path.expandvars(user_config["val_data_folder"]),
+        required_inputs=required_inputs
     )
 
     train_data_loader = Train_DL.get_data_loader()
@@ -139,7 +309,9 @@ def train(
     # Set random seed before initializing the model weights
     tf.random.set_seed(user_config["random_seed"])
 
-    model = MainModel(tr_stations, tr_time_offsets, user_config)
+    # the precision policy of the user config only applies to the layers of this model
+    with precision_policy_scope(user_config):
+        model = MainModel(tr_stations, tr_time_offsets, user_config)
 
     # set hyper-parameters
     nb_epoch = user_config["nb_epoch"]
@@ -147,10 +319,10 @@ def train(
     max_k_ghi = user_config["max_k_ghi"]
 
     # Optimizer: Adam - for decaying learning rate
-    optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+    optimizer = get_optimizer(learning_rate, user_config)
 
-    # Objective/Loss function: MSE Loss
-    loss_fn = tf.keras.losses.MeanSquaredError()
+    # Objective/Loss function: MSE Loss, averaged over the daytime predictions by weighted_loss
+    loss_fn = tf.keras.losses.MeanSquaredError(reduction="sum")
 
     # Define tensorboard metrics
     train_loss = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
@@ -161,6 +333,10 @@ def train(
     # Checkpoint management (for model save/restore)
     manager, ckpt, early_stop_metric, start_epoch, start_time = manage_model_checkpoints(optimizer, model, user_config)
 
+    # Graph-compiled steps, unless "run_eagerly" is set
+    compiled_train_step, compiled_test_step = get_step_functions(
+        model, optimizer, loss_fn, max_k_ghi, Train_DL.get_input_signature(), user_config)
+
     # Get tensorboard file writers
     train_summary_writer, test_summary_writer, hparam_summary_writer, train_step_writer, test_step_writer = \
         get_summary_writers(start_time)
@@ -175,35 +351,44 @@ def train(
             'input_seq_length': user_config["input_seq_length"],
             'nb_feature_maps': user_config["nb_feature_maps"],
             'nb_dense_units': user_config["nb_dense_units"],
-            'use_all_data_at_epoch': user_config["use_all_data_at_epoch"]
+            'use_all_data_at_epoch': user_config["use_all_data_at_epoch"],
+            'precision_policy': user_config.get("precision_policy", "float32")
         })
 
-    n_train_steps = len(glob.glob(user_config["train_data_folder"] + "/*hdf5"))
-    n_val_steps = len(glob.glob(user_config["val_data_folder"] + "/*hdf5"))
+    n_train_steps = Train_DL.nb_batches
+    n_val_steps = Val_DL.nb_batches
+
+    # the training step outputs are checked for NaNs every "check_numerics_steps" steps (0: never), since the check
+    # waits for the step to complete
+    check_numerics_steps = user_config.get("check_numerics_steps", 0)
 
     # training starts here
-    with tqdm.tqdm("training", total=nb_epoch) as pbar:
+    # the loaders are closed at the end of the training, which stops their reader processes and file staging
+    with tqdm.tqdm("training", total=nb_epoch) as pbar, contextlib.closing(Train_DL), contextlib.closing(Val_DL):
         pbar.update(start_epoch)
         for epoch in range(start_epoch, nb_epoch):
 
             current_train_steps_start_point = epoch * n_train_steps
             current_val_steps_start_point = epoch * n_val_steps
 
+            # the inputs unused when training on image data only are not read
+            use_image_data_only = epoch < user_config["use_all_data_at_epoch"]
+            for DL in (Train_DL, Val_DL):
+                DL.skip_inputs(MainModel.IMAGE_ONLY_UNUSED_INPUTS if use_image_data_only else ())
+
             with tqdm.tqdm("Train steps", total=n_train_steps) as train_pbar:
 
                 # Train the model using the training set for one epoch
                 for i, minibatch in enumerate(train_data_loader):
-                    loss, y_train, y_pred, weight = train_step(
-                        model,
-                        optimizer,
-                        loss_fn,
-                        max_k_ghi,
+                    loss, y_train, y_pred, weights = compiled_train_step(
                         x_train=minibatch[:-1],
                         y_train=minibatch[-1],
-                        use_image_data_only=(epoch < user_config["use_all_data_at_epoch"])
+                        use_image_data_only=use_image_data_only
                     )
-                    train_loss(loss, sample_weight=weight)
-                    train_rmse(y_train, y_pred, sample_weight=weight)
+                    if check_numerics_steps and i % check_numerics_steps == 0:
+                        check_step_numerics(loss=loss, y_pred=y_pred)
+                    train_loss(loss, sample_weight=tf.reduce_sum(weights))
+                    train_rmse(y_train, y_pred, sample_weight=weights)
 
                     train_pbar.update(1)
 
@@ -222,16 +407,13 @@ def train(
 
                 # Evaluate model performance on the validation set after training for one epoch
                 for j, minibatch in enumerate(val_data_loader):
-                    loss, y_test, y_pred, weight = test_step(
-                        model,
-                        loss_fn,
-                        max_k_ghi,
+                    loss, y_test, y_pred, weights = compiled_test_step(
                         x_test=minibatch[:-1],
                         y_test=minibatch[-1],
-                        use_image_data_only=(epoch < user_config["use_all_data_at_epoch"])
+                        use_image_data_only=use_image_data_only
                     )
-                    test_loss(loss, sample_weight=weight)
-                    test_rmse(y_test, y_pred, sample_weight=weight)
+                    test_loss(loss, sample_weight=tf.reduce_sum(weights))
+                    test_rmse(y_test, y_pred, sample_weight=weights)
 
                     val_pbar.update(1)
 
@@ -1,6 +1,9 @@
+import collections
+import contextlib
 import datetime
 import json
 import math
+import multiprocessing.util
 import os
 import typing
 import warnings
@@ -142,25 +145,104 @@ def decompress_array(
     return array
 
 
+# per-process pool of read-only HDF5 archive handles (path -> h5py.File), in LRU order
+HDF5_READER_POOL_SIZE = 32
+_hdf5_reader_pool = collections.OrderedDict()
+_hdf5_reader_pool_pid = None
+# LUTs read from the pooled readers (id(reader) -> (reader, {lut_name: lut_array})), dropped with their reader
+_hdf5_reader_luts = {}
+
+
+def close_hdf5_readers() -> None:
+    """Closes all the HDF5 archive handles opened by ``get_hdf5_reader`` in the current process."""
+    # the pid is kept, so that the process does not register another finalizer if it opens readers again
+    if _hdf5_reader_pool_pid == os.getpid():
+        for reader in _hdf5_reader_pool.values():
+            reader.close()
+    _hdf5_reader_pool.clear()
+    _hdf5_reader_luts.clear()
+
+
+def get_hdf5_reader(
+        hdf5_path: str,
+        max_open_files: typing.Optional[int] = None,
+) -> h5py.File:
+    """Returns a read-only HDF5 archive reader for the given path, opening it only if needed.
+
+    Readers are kept open in a per-process LRU pool so that repeated accesses to the same archive (e.g. for the
+    frames of a history sequence, for neighbouring T0s, or for multiple stations) do not reopen the file. The least
+    recently used reader is closed once more than ``max_open_files`` archives are open. The returned reader must not
+    be closed by the caller; all readers are closed automatically when the (worker) process exits.
+    """
+    global _hdf5_reader_pool_pid
+    if _hdf5_reader_pool_pid != os.getpid():
+        # handles inherited from a parent process through fork cannot be shared safely; start from an empty pool.
+        # The finalizers of the parent are not run by forked workers, so every process registers its own, once
+        _hdf5_reader_pool.clear()
+        _hdf5_reader_luts.clear()
+        _hdf5_reader_pool_pid = os.getpid()
+        multiprocessing.util.Finalize(None, close_hdf5_readers, exitpriority=10)
+    if hdf5_path in _hdf5_reader_pool:
+        _hdf5_reader_pool.move_to_end(hdf5_path)
+        return _hdf5_reader_pool[hdf5_path]
+    max_open_files = max_open_files or HDF5_READER_POOL_SIZE
+    while len(_hdf5_reader_pool) >= max_open_files:
+        _, reader = _hdf5_reader_pool.popitem(last=False)
+        _hdf5_reader_luts.pop(id(reader), None)
+        reader.close()
+    reader = h5py.File(hdf5_path, "r")
+    _hdf5_reader_pool[hdf5_path] = reader
+    _hdf5_reader_luts[id(reader)] = (reader, {})
+    return reader
+
+
+@contextlib.contextmanager
+def open_hdf5(hdf5_path: str, use_reader_pool: bool = True) -> typing.Iterator[h5py.File]:
+    """Context manager yielding a read-only HDF5 archive reader.
+
+    If ``use_reader_pool`` is set, the reader comes from (and is left open in) the pool of ``get_hdf5_reader``;
+    otherwise, the archive is opened and closed like a regular ``h5py.File(...)`` context.
+    """
+    if use_reader_pool:
+        yield get_hdf5_reader(hdf5_path)
+    else:
+        with h5py.File(hdf5_path, "r") as reader:
+            yield reader
+
+
+def _get_hdf5_lut_index(reader: h5py.File, dataset_lut_name: str, sample_idx: int) -> int:
+    """Returns the LUT entry of a sample, reading the whole LUT only once for pooled readers."""
+    lut_entry = _hdf5_reader_luts.get(id(reader)) if _hdf5_reader_pool_pid == os.getpid() else None
+    if lut_entry is None or lut_entry[0] is not reader:
+        return reader[dataset_lut_name][sample_idx]
+    luts = lut_entry[1]
+    if dataset_lut_name not in luts:
+        luts[dataset_lut_name] = reader[dataset_lut_name][()]
+    return luts[dataset_lut_name][sample_idx]
+
+
 def fetch_hdf5_sample(
         dataset_name: str,
-        reader: h5py.File,
+        reader: typing.Union[h5py.File, str],
         sample_idx: int,
 ) -> typing.Any:
     """Decodes and returns a single sample from an HDF5 dataset.
     Args:
         dataset_name: name of the HDF5 dataset to fetch the sample from using the reader. In the context of
             the GHI prediction project, this may be for example an imagery channel name (e.g. "ch1").
-        reader: an HDF5 archive reader obtained via ``h5py.File(...)`` which can be used for dataset indexing.
+        reader: an HDF5 archive reader obtained via ``h5py.File(...)`` which can be used for dataset indexing, or
+            the path to the HDF5 archive, in which case the reader is taken from the pool of ``get_hdf5_reader``.
         sample_idx: the integer index (or offset) that corresponds to the position of the sample in the dataset.
     Returns:
         The sample. This function will automatically decompress the sample if it was compressed. It the sample is
         unavailable because the input was originally masked, the function will return ``None``. The sample itself
         may be a scalar or a numpy array.
     """
+    if isinstance(reader, str):
+        reader = get_hdf5_reader(reader)
     dataset_lut_name = dataset_name + "_LUT"
     if dataset_lut_name in reader:
-        sample_idx = reader[dataset_lut_name][sample_idx]
+        sample_idx = _get_hdf5_lut_index(reader, dataset_lut_name, sample_idx)
         if sample_idx == -1:
             return None  # unavailable
     dataset = reader[dataset_name]
@@ -185,20 +267,80 @@ def fetch_hdf5_sample(
     return array
 
 
+def fetch_hdf5_window(
+        dataset_name: str,
+        reader: typing.Union[h5py.File, str],
+        sample_idx: int,
+        window: typing.Tuple[int, int, int, int],
+) -> typing.Optional[np.ndarray]:
+    """Decodes and returns a rectangular window of a single 2D sample from an HDF5 dataset.
+    Args:
+        dataset_name: name of the HDF5 dataset to fetch the sample from (see ``fetch_hdf5_sample``).
+        reader: an HDF5 archive reader, or the path to the HDF5 archive (see ``fetch_hdf5_sample``).
+        sample_idx: the integer index (or offset) that corresponds to the position of the sample in the dataset.
+        window: the ``(row_start, row_stop, col_start, col_stop)`` bounds of the window, which are clipped to the
+            sample (negative starts included).
+    Returns:
+        The window of the sample, or ``None`` if the sample is unavailable. Samples stored as raw (possibly chunked)
+        arrays are read as a hyperslab, which only touches the chunks overlapping the window; compressed samples
+        are fully decoded then cropped, the full sample being released right away.
+    """
+    if isinstance(reader, str):
+        reader = get_hdf5_reader(reader)
+    row_start, row_stop, col_start, col_stop = (max(int(bound), 0) for bound in window)
+    dataset = reader[dataset_name]
+    if "compr_type" in dataset.attrs:
+        sample = fetch_hdf5_sample(dataset_name, reader, sample_idx)
+        if sample is None:
+            return None
+        window_array = sample[row_start:row_stop, col_start:col_stop].copy()
+        del sample
+        return window_array
+    dataset_lut_name = dataset_name + "_LUT"
+    if dataset_lut_name in reader:
+        sample_idx = _get_hdf5_lut_index(reader, dataset_lut_name, sample_idx)
+        if sample_idx == -1:
+            return None  # unavailable
+    row_stop, col_stop = min(row_stop, dataset.shape[1]), min(col_stop, dataset.shape[2])
+    return dataset[sample_idx, row_start:row_stop, col_start:col_stop]
+
+
+def get_time_features(epoch_seconds: np.ndarray) -> np.ndarray:
+    """Computes the cyclical time features of a set of timestamps.
+    Args:
+        epoch_seconds: integer array of timestamps, in seconds since the epoch.
+    Returns:
+        A ``(N, 4)`` float32 array holding the sine and cosine of the second of the day, followed by the sine and
+        cosine of the day of the year, both cycles being scaled to 2*pi.
+    """
+    SECONDS_PER_DAY = 24 * 60 * 60
+    DAYS_PER_YEAR = 365
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64).ravel()
+    second_of_day = epoch_seconds % SECONDS_PER_DAY
+    days = epoch_seconds.astype("datetime64[s]").astype("datetime64[D]")
+    day_of_year = (days - days.astype("datetime64[Y]")).astype(np.int64) + 1
+    day_cycle_rad = second_of_day / SECONDS_PER_DAY * 2.0 * np.pi
+    year_cycle_rad = day_of_year / DAYS_PER_YEAR * 2.0 * np.pi
+    return np.stack((np.sin(day_cycle_rad), np.cos(day_cycle_rad),
+                     np.sin(year_cycle_rad), np.cos(year_cycle_rad)), axis=1).astype(np.float32)
+
+
 def viz_hdf5_imagery(
         hdf5_path: str,
         channels: typing.List[str],
         dataframe_path: typing.Optional[str] = None,
         stations: typing.Optional[typing.Dict[str, typing.Tuple]] = None,
         copy_last_if_missing: bool = True,
+        use_reader_pool: bool = False,
 ) -> None:
     """Displays a looping visualization of the imagery channels saved in an HDF5 file.
     This visualization requires OpenCV3+ ('cv2'), and will loop while refreshing a local window until the program
-    is killed, or 'q' is pressed. The visualization can also be paused by pressing the space bar.
+    is killed, or 'q' is pressed. The visualization can also be paused by pressing the space bar. If
+    ``use_reader_pool`` is set, the archive is read through the reader pool of ``get_hdf5_reader``.
     """
     assert os.path.isfile(hdf5_path), f"invalid hdf5 path: {hdf5_path}"
     assert channels, "list of channels must not be empty"
-    with h5py.File(hdf5_path, "r") as h5_data:
+    with open_hdf5(hdf5_path, use_reader_pool=use_reader_pool) as h5_data:
         global_start_idx = h5_data.attrs["global_dataframe_start_idx"]
         global_end_idx = h5_data.attrs["global_dataframe_end_idx"]
         archive_lut_size = global_end_idx - global_start_idx
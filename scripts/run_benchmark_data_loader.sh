@@ -0,0 +1 @@
+python ../code/benchmark_data_loader.py -u="../code/eval_user_cfg_cnn.json" -t="../train_cfg_local.json" --steps=200 --model_step
@@ -0,0 +1 @@
+python ../code/compute_statistics.py ../train_cfg_local.json -o="../data/statistics.json" -w=8
@@ -0,0 +1 @@
+python ../code/export_quantized_model.py -u="../code/eval_user_cfg_lstm.json" -t="../train_cfg_local.json" -o="../model/my_model_int8.tflite" -n=512
@@ -5,17 +5,8 @@
 #SBATCH --mem=10000M
 #SBATCH --reservation=IFT6759_2020-02-26
 
-# date
-# echo ~~~~~~~~~~~~removing tmp files...
-# rm -rf $SLURM_TMPDIR/*
-# date
-# echo ~~~~~~~~~~~~copying train files...
-# mkdir $SLURM_TMPDIR/train_crops/
-# cp ../../data/train_crops_seq_3/batch_[567890]* $SLURM_TMPDIR/train_crops/
-# date
-# echo ~~~~~~~~~~~~copying val files...
-# mkdir $SLURM_TMPDIR/val_crops/
-# cp ../../data/val_crops_seq_3/batch_[234567890]* $SLURM_TMPDIR/val_crops/
+# batch files are no longer copied here: set "staging_dir": "$SLURM_TMPDIR" (and optionally "staging_max_gb")
+# in the user config to have the DataLoader stage them in the background while training starts
 date
 echo ~~~~~~~~~~~~setting up environement
 module load python/3.7